@@ -0,0 +1,141 @@
+"""
+Checks and a benchmark for the RSLisp compiler, comparing rs_lisp.lisp_compile to the tree-walking rs_lisp.lisp_eval.
+Run from the repository root: python benchmarks/rs_lisp_eval.py [-n CASES] [--seed SEED]
+"""
+import random
+import re
+import sys
+from argparse import ArgumentParser
+from copy import deepcopy
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from red_star.plugins.rs_lisp import lisp_compile, lisp_eval, parse, standard_env  # noqa: E402
+
+symbols = ['x', 'y', 'lst', 'lst:0', 'lst:x', 'lst:1:0', 'nested:0:1', 'f', 'g', '+', '-', '*', 'len', 'car', 'str',
+           'undefined', 'x:y']
+constants = ['0', '1', '2', '3', '"s"', '"ab"', '-1', '1.5']
+forms = ['if', 'def', ':=', 'lambda', 'while', 'print', 'try', 'unquote', 'raise', 'quote', '>>', 'args']
+_address = re.compile(r" at 0x[0-9a-f]+")
+
+loop_programs = {
+    "while counter 20k": '(do (def i 0) (def s 0) (while (< i 20000) (do (:= s (+ s i)) (:= i (+ i 1)))) s)',
+    "list index loop 10k": '(do (def l (list 0 0 0)) (def i 0) (while (< i 10000) (do (:= l:1 (+ l:1 i)) '
+                           '(:= i (+ i 1)))) l:1)',
+    "recursive fib 18": '(do (def fib (lambda (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))) (fib 18))',
+    "map over lambda 20k": '(do (def sq (lambda (x) (* x x))) (sum (map sq (range 20000))))',
+    "print loop 2k": '(do (def i 0) (while (< i 2000) (do (print "n" i) (:= i (+ i 1)))) 1)',
+}
+
+
+def random_form(rng, depth):
+    form = rng.choice(forms)
+    arg_count = rng.randint(0, 4)
+    if form == 'quote' and rng.random() < 0.5:
+        return "'(" + ' '.join(random_expression(rng, depth + 1) for _ in range(arg_count)) + ')'
+    elif form == ':=' and rng.random() < 0.7:
+        target = rng.choice(['x', 'y', 'lst:0', 'lst:x', 'nested:0:1', 'zz', '3'])
+        return f'(:= {target} {random_expression(rng, depth + 1)})'
+    elif form == 'def' and rng.random() < 0.7:
+        return f'(def {rng.choice(["x", "y", "f", "lst"])} {random_expression(rng, depth + 1)})'
+    elif form == 'lambda' and rng.random() < 0.7:
+        return f'(lambda ({rng.choice(["x", "a b", "", "y"])}) {random_expression(rng, depth + 1)})'
+    elif form == 'while' and rng.random() < 0.7:
+        return f'(while (< x {rng.randint(0, 5)}) (do (:= x (+ x 1)) {random_expression(rng, depth + 1)}))'
+    elif form == 'args' and rng.random() < 0.7:
+        return '(args ' + rng.choice(["", "0", "5", "* 1", "1 *", "0 2", '"*"']) + ')'
+    elif form == '>>':
+        return '(>> "upper" "abc")' if rng.random() < 0.5 else f'(>> "nope" {random_expression(rng, depth + 1)})'
+    return '(' + form + ' ' + ' '.join(random_expression(rng, depth + 1) for _ in range(arg_count)) + ')'
+
+
+def random_expression(rng, depth=0):
+    roll = rng.random()
+    if depth > 3 or roll < 0.3:
+        return rng.choice(symbols + constants)
+    elif roll < 0.65:
+        return random_form(rng, depth)
+    return '(' + ' '.join(random_expression(rng, depth + 1) for _ in range(rng.randint(0, 4))) + ')'
+
+
+def describe(value):
+    if callable(value):
+        return "callable"
+    elif isinstance(value, (map, filter, zip, range)):
+        return type(value).__name__
+    return _address.sub("", repr(value))
+
+
+def run(evaluate, ast):
+    """
+    :return: The result or error of running the program, and the state it left behind.
+    """
+    env = standard_env(max_runtime=0.1)
+    env.update({'x': 0, 'y': 1, 'lst': [[1, 2], [3, 4], 5], 'nested': [[0, [9, 8]]], 'args': ['a', 'b', 'c'],
+                'argstring': 'a b c'})
+    try:
+        result = "ok", describe(evaluate(ast, env))
+    except RecursionError:
+        return None
+    except Exception as e:
+        if "ran too long" in str(e):
+            return None
+        result = "error", type(e).__name__, _address.sub("", str(e))
+    return result, _address.sub("", env['_rsoutput']), describe(env.get('x')), describe(env['lst'])
+
+
+def run_compiled(ast, env):
+    return lisp_compile(ast)(env)
+
+
+def check(rng, cases):
+    compared = errors = 0
+    for _ in range(cases):
+        source = '(do ' + ' '.join(random_expression(rng) for _ in range(rng.randint(1, 4))) + ')'
+        try:
+            ast = parse(source)
+        except Exception:
+            continue
+        # Both evaluators hand quoted lists to the program as-is, so each gets its own copy
+        expected = run(lisp_eval, deepcopy(ast))
+        result = run(run_compiled, deepcopy(ast))
+        # Recursion depth and the time limit are hit at different points, so those runs can't be compared
+        if expected is None or result is None:
+            continue
+        assert result == expected, (source, expected, result)
+        compared += 1
+        errors += result[0][0] == "error"
+    print(f"lisp_compile: {compared} programs give the same results, output and errors as lisp_eval "
+          f"({errors} of them errors)")
+
+
+def best_time(func, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best * 1000
+
+
+def benchmark():
+    for name, source in loop_programs.items():
+        ast = parse(source)
+        tree_walk = best_time(lambda: lisp_eval(ast, standard_env(max_runtime=60)))
+        compiled = best_time(lambda: lisp_compile(ast)(standard_env(max_runtime=60)))
+        print(f"{name}: tree-walking {tree_walk:.1f}ms, compiled {compiled:.1f}ms")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--cases", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    check(random.Random(args.seed), args.cases)
+    benchmark()
+
+
+if __name__ == "__main__":
+    main()
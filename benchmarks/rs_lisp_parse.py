@@ -0,0 +1,118 @@
+"""
+Checks and a benchmark for the RSLisp reader, rs_lisp.read_from_tokens.
+Run from the repository root: python benchmarks/rs_lisp_parse.py [-n CASES] [--seed SEED]
+"""
+import random
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from red_star.plugins.rs_lisp import Empty, atom, l_restore, read_from_tokens, reprint, tokenize  # noqa: E402
+from red_star.rs_errors import CustomCommandSyntaxError  # noqa: E402
+
+atoms = ['a', 'b:1', '12', '0x1f', '1.5', 'true', 'False', '"str \\" x"', '"a;b"', '; comment\n', '"\\n"', '-3',
+         'x:y:0']
+
+
+def reference_read_from_tokens(tokens):
+    """
+    The original reader, which pops tokens off the front of the list and recurses once per nesting level.
+    """
+    if len(tokens) == 0:
+        raise CustomCommandSyntaxError('unexpected EOF while reading')
+    token = tokens.pop(0)
+    if token[0] == token[-1] == '"':
+        return ['quote', l_restore(token[1:-1])]
+    elif '(' == token:
+        token_list = []
+        while tokens[0] != ')':
+            t = reference_read_from_tokens(tokens)
+            if not isinstance(t, Empty) and t != '':
+                token_list.append(t)
+        tokens.pop(0)
+        return token_list
+    elif token.startswith(';'):
+        return Empty()
+    elif ')' == token:
+        raise CustomCommandSyntaxError('unexpected )')
+    else:
+        return atom(token.strip())
+
+
+def random_program(rng, depth=0):
+    if depth > 4 or rng.random() < 0.3:
+        return rng.choice(atoms)
+    return '(' + ' '.join(random_program(rng, depth + 1) for _ in range(rng.randint(0, 5))) + ')'
+
+
+def read(reader, program):
+    """
+    :return: The AST with the type of every atom, and its reprint, or None if the program couldn't be read.
+    """
+    def typed(x):
+        if isinstance(x, Empty):
+            return "Empty"
+        elif isinstance(x, list):
+            return [typed(i) for i in x]
+        return type(x).__name__, x
+    try:
+        ast = reader(tokenize(program))
+    except (CustomCommandSyntaxError, IndexError):
+        return None
+    return typed(ast), None if isinstance(ast, Empty) else reprint(ast)
+
+
+def check(rng, cases):
+    for _ in range(cases):
+        program = random_program(rng)
+        malformed = rng.random() < 0.1
+        if malformed:
+            program = program[:rng.randint(0, len(program))]
+        result = read(read_from_tokens, program)
+        assert result == read(reference_read_from_tokens, program), program
+        if not malformed and result[1] is not None:
+            assert read(read_from_tokens, result[1]) == result, program
+    print(f"read_from_tokens: {cases} programs read the same as the reference and survive reprint")
+
+
+def generated_program(token_count):
+    parts = []
+    for _ in range(token_count // 25):
+        parts.append('(do (def x (+ 1 2)) (print "hi" x) (while (< x 10) (:= x (+ x 1))))')
+    return "(do " + " ".join(parts) + ")"
+
+
+def timed(reader, tokens, repeat=3):
+    """
+    :return: The best time out of several runs, in milliseconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        tokens_copy = list(tokens)
+        start = perf_counter()
+        reader(tokens_copy)
+        best = min(best, perf_counter() - start)
+    return best * 1000
+
+
+def benchmark():
+    for token_count in (1000, 10000, 100000):
+        tokens = tokenize(generated_program(token_count))
+        print(f"{len(tokens)} tokens: {timed(read_from_tokens, tokens):.1f}ms "
+              f"(reference {timed(reference_read_from_tokens, tokens):.1f}ms)")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--cases", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    check(random.Random(args.seed), args.cases)
+    benchmark()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Property checks and a benchmark for rs_utils.split_message and close_markdown.
+Run from the repository root: python benchmarks/split_message.py [-n CASES] [--seed SEED]
+"""
+import random
+import re
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from red_star import rs_utils  # noqa: E402
+from red_star.rs_utils import close_markdown, iter_split_message, split_message  # noqa: E402
+
+# Markdown markers and text to build inputs from.
+tokens = ["**", "*", "~~", "__", "||", "```", "`", "```py\n", "\n", "\n", "a", "bc", "word ", "x" * 30, "é", " "]
+
+
+def reference_close_markdown(input_string):
+    """
+    The original close_markdown, which counts every marker once per occurrence. Its closers come out of a set, so
+    only which markers it closes is compared, not their order.
+    """
+    code_block_matches = re.findall(r"```\w+\n", input_string)
+    in2 = re.sub(r"```\w+\n", "```", input_string)
+    md_matches = re.findall(r"(\*\*|\*|~~|__|\|\||```|`)", in2)
+    unclosed_matches = "".join({s for s in md_matches if md_matches.count(s) % 2 != 0})
+    output = input_string + unclosed_matches
+    if code_block_matches:
+        unclosed_matches = unclosed_matches.replace("```", code_block_matches[0], 1)
+    return output, unclosed_matches
+
+
+class ReferenceHang(Exception):
+    pass
+
+
+def reference_split_message(input_string, max_len=2000, splitter="\n"):
+    """
+    The original split_message, with two changes:
+    - It calls the current close_markdown. That closes the same markers as the original (checked above), but in a
+      fixed order rather than set order, so the chunks can be compared exactly.
+    - It gives up with ReferenceHang where the original would loop forever: once a snippet had to be shrunk to
+      nothing to fit next to the reopened markdown, it kept cutting off no text at all.
+    """
+    final_strings = []
+    open_markdown = ""
+    if len(input_string) <= max_len:
+        return [input_string]
+    iterations = 0
+    while True:
+        snippet = input_string[:max_len - len(open_markdown)]
+        while True:
+            iterations += 1
+            if iterations > 10 * (len(input_string) + max_len):
+                raise ReferenceHang
+            # Find the nearest splitter character to the maximum length
+            snippet = snippet.rsplit(splitter, 1)[0] or snippet
+            cut_length = len(snippet)
+            snippet_marked_down = open_markdown + snippet
+            # Close the markdown
+            snippet_marked_down, extra_md = close_markdown(snippet_marked_down)
+            # If, with markdown closed, it fits, continue. Otherwise, run the loop again.
+            if len(snippet_marked_down) <= max_len:
+                open_markdown = extra_md
+                break
+            elif len(snippet.strip().rsplit(splitter, 1)) <= 1:
+                snippet = snippet[:max_len - len(snippet_marked_down)]
+        if not cut_length:
+            raise ReferenceHang
+        final_strings.append(snippet_marked_down)
+        input_string = input_string[cut_length:]  # Cut down the input string for the next iteration
+        if not input_string:
+            return final_strings
+
+
+def random_text(rng, length):
+    return "".join(rng.choice(tokens) for _ in range(length))
+
+
+def check_close_markdown(rng, cases):
+    for _ in range(cases):
+        text = random_text(rng, rng.randint(0, 60))
+        closed, reopen = close_markdown(text)
+        ref_closed, ref_reopen = reference_close_markdown(text)
+        assert closed.startswith(text), text
+        assert sorted(closed[len(text):]) == sorted(ref_closed[len(text):]), text
+        assert sorted(reopen) == sorted(ref_reopen), text
+    print(f"close_markdown: {cases} cases match the reference")
+
+
+def split_bodies(text, max_len):
+    """
+    Splits a string, and recovers which part of it went into every chunk, by recording the close_markdown call that
+    produced each chunk. Its argument is the chunk's text, after the markdown reopened from the previous chunk, unless
+    that didn't fit and was dropped.
+    :return: A list of (chunk, text) tuples.
+    """
+    calls = []
+
+    def recording_close_markdown(string):
+        result = close_markdown(string)
+        calls.append((string, result))
+        return result
+
+    rs_utils.close_markdown = recording_close_markdown
+    try:
+        result = []
+        reopened = ""
+        pos = 0
+        for chunk in iter_split_message(text, max_len):
+            string, (closed, next_reopened) = calls[-1]
+            assert closed == chunk, (text, max_len)
+            if reopened and string.startswith(reopened) and text.startswith(string[len(reopened):], pos):
+                string = string[len(reopened):]
+            assert text.startswith(string, pos), (text, max_len)
+            result.append((chunk, string))
+            pos += len(string)
+            reopened = next_reopened
+        return result
+    finally:
+        rs_utils.close_markdown = close_markdown
+
+
+def check_split_message(rng, cases):
+    compared = matching = hung = 0
+    for _ in range(cases):
+        text = random_text(rng, rng.randint(0, 500))
+        max_len = rng.choice([40, 80, 120, 200, 2000])
+        chunks = split_message(text, max_len)
+        assert chunks == list(iter_split_message(text, max_len)), (text, max_len)
+        if len(text) <= max_len:
+            assert chunks == [text], (text, max_len)
+            continue
+        assert all(len(chunk) <= max_len for chunk in chunks), (text, max_len)
+        bodies = split_bodies(text, max_len)
+        assert [chunk for chunk, _ in bodies] == chunks, (text, max_len)
+        assert "".join(body for _, body in bodies) == text, (text, max_len)
+        assert all(body for _, body in bodies), (text, max_len)
+        try:
+            reference = reference_split_message(text, max_len)
+        except ReferenceHang:
+            # The new version drops markdown that cannot be reopened or moves on by one character instead.
+            hung += 1
+            continue
+        # The original also split the last piece of the string at its last line break, even when all of it fit in
+        # one chunk. Every chunk before that has to be the same.
+        assert reference[:len(chunks) - 1] == chunks[:-1], (text, max_len)
+        compared += 1
+        matching += reference == chunks
+    print(f"split_message: {cases} cases within length and covering their input exactly once; "
+          f"{compared} compared to the reference, {matching} of them identical, the rest up to the last chunk; "
+          f"{hung} skipped because the original never finished")
+
+
+def log_lines(count):
+    return "".join(f"`{i:05}` **user{i % 37}** deleted a message in __#general__: {'x' * (i % 90)}\n"
+                   for i in range(count))
+
+
+def timed(func, *args):
+    start = perf_counter()
+    result = func(*args)
+    return result, (perf_counter() - start) * 1000
+
+
+def benchmark():
+    # The original split_message sliced and rescanned the rest of the string for every chunk, and never finished on
+    # the larger payloads, so only the current one is timed here.
+    for count in (200, 2000, 6000):
+        text = log_lines(count)
+        chunks, ms = timed(split_message, text)
+        print(f"split_message, {count} log lines / {len(text)} chars: {ms:.1f}ms, {len(chunks)} chunks")
+    text = "**a** `b` ~~c~~ " * 2000
+    _, ms = timed(close_markdown, text)
+    _, ref_ms = timed(reference_close_markdown, text)
+    print(f"close_markdown, {len(text)} chars: {ms:.1f}ms (reference {ref_ms:.1f}ms)")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--cases", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    check_close_markdown(rng, args.cases * 5)
+    check_split_message(rng, args.cases)
+    benchmark()
+
+
+if __name__ == "__main__":
+    main()
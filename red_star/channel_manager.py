@@ -16,6 +16,9 @@ class ChannelManager:
             "channels": {},
             "categories": {}
         }
+        # guild ID -> category -> frozenset of channel IDs; a copy of the categories in conf, for quick lookups
+        self.category_index = {}
+        self.rebuild_index()
 
     def add_guild(self, gid):
         if gid not in self.conf:
@@ -29,6 +32,26 @@ class ChannelManager:
         new_categories.update(guild_conf["categories"])
         guild_conf["categories"] = new_categories
         self.conf.save()
+        self._index_guild(gid)
+
+    def rebuild_index(self):
+        """
+        Rebuilds the category index from the config. Needs to be called if the config is edited directly.
+        """
+        self.category_index = {}
+        for gid in self.conf:
+            self._index_guild(gid)
+
+    def _index_guild(self, gid):
+        try:
+            categories = self.conf[gid]["categories"]
+            self.category_index[int(gid)] = {category: frozenset(channels) for category, channels in categories.items()}
+        except (KeyError, TypeError, ValueError):  # not a guild entry
+            pass
+
+    def _index_category(self, guild, category):
+        channels = self.conf[str(guild.id)]["categories"][category]
+        self.category_index.setdefault(guild.id, {})[category] = frozenset(channels)
 
     def get_channel(self, guild, chantype):
         gid = str(guild.id)
@@ -56,18 +79,23 @@ class ChannelManager:
             return None
 
     def channel_in_category(self, guild, category, channel):
-        guild_categories = self.conf[str(guild.id)]["categories"]
-        if category.lower() not in guild_categories:
-            return False
-        if channel.id not in guild_categories[category.lower()]:
+        try:
+            guild_categories = self.category_index[guild.id]
+        except KeyError:
             return False
-        return True
+        try:
+            channels = guild_categories[category]
+        except KeyError:
+            channels = guild_categories.get(category.lower(), ())
+        return channel.id in channels
 
     def add_channel_to_category(self, guild, category, channel):
-        category = self.conf[str(guild.id)]["categories"].setdefault(category.lower(), [])
+        category_name = category.lower()
+        category = self.conf[str(guild.id)]["categories"].setdefault(category_name, [])
         if channel.id not in category:
             category.append(channel.id)
             self.conf.save()
+            self._index_category(guild, category_name)
             return True
         else:
             return False
@@ -78,6 +106,7 @@ class ChannelManager:
         if self.channel_in_category(guild, category, channel):
             self.conf[gid]["categories"][category].remove(channel.id)
             self.conf.save()
+            self._index_category(guild, category)
             return True
         else:
             return False
@@ -62,8 +62,10 @@ class RedStar(AutoShardedClient):
 
     async def close(self):
         self.logger.warning("Logging out and shutting down.")
+        self.command_dispatcher.scheduler.close()
         await self.plugin_manager.deactivate_all()
         self.config_manager.save_config()
+        await self.config_manager.flush_config_files()
         await super().close()
 
     async def on_error(self, event_method, *pargs, **kwargs):
@@ -75,7 +77,7 @@ class RedStar(AutoShardedClient):
         await self.plugin_manager.hook_event("on_resumed")
 
     async def on_typing(self, channel, user, when):
-        if isinstance(channel, DMChannel):
+        if not self.plugin_manager.has_subscribers("on_typing") or isinstance(channel, DMChannel):
             return
         if self.channel_manager.channel_in_category(channel.guild, "no_read", channel):
             return
@@ -92,27 +94,29 @@ class RedStar(AutoShardedClient):
             await self.plugin_manager.hook_event("on_dm_message", msg)
 
     async def on_message_delete(self, msg):
-        if msg.guild is None:
+        if msg.guild is None or not self.plugin_manager.has_subscribers("on_message_delete"):
             return
         if self.channel_manager.channel_in_category(msg.guild, "no_read", msg.channel):
             return
         await self.plugin_manager.hook_event("on_message_delete", msg)
 
     async def on_message_edit(self, before, after):
-        if after.guild is None:
+        if after.guild is None or not self.plugin_manager.has_subscribers("on_message_edit"):
             return
         if self.channel_manager.channel_in_category(after.guild, "no_read", after.channel):
             return
         await self.plugin_manager.hook_event("on_message_edit", before, after)
 
     async def on_reaction_add(self, reaction, user):
-        if reaction.message.guild is None:
+        if not self.plugin_manager.has_subscribers("on_reaction_add") or reaction.message.guild is None:
             return
         if self.channel_manager.channel_in_category(reaction.message.guild, "no_read", reaction.message.channel):
             return
         await self.plugin_manager.hook_event("on_reaction_add", reaction, user)
 
     async def on_raw_reaction_add(self, payload):
+        if not self.plugin_manager.has_subscribers("on_raw_reaction_add"):
+            return
         if payload.channel_id is not None \
                 and self.channel_manager.channel_in_category(
                     Object(payload.guild_id),
@@ -122,13 +126,15 @@ class RedStar(AutoShardedClient):
         await self.plugin_manager.hook_event("on_raw_reaction_add", payload)
 
     async def on_reaction_remove(self, reaction, user):
-        if reaction.message.guild is None:
+        if not self.plugin_manager.has_subscribers("on_reaction_remove") or reaction.message.guild is None:
             return
         if self.channel_manager.channel_in_category(reaction.message.guild, "no_read", reaction.message.channel):
             return
         await self.plugin_manager.hook_event("on_reaction_remove", reaction, user)
 
     async def on_raw_reaction_remove(self, payload):
+        if not self.plugin_manager.has_subscribers("on_raw_reaction_remove"):
+            return
         if payload.channel_id is not None \
                 and self.channel_manager.channel_in_category(
                     Object(payload.guild_id),
@@ -138,7 +144,7 @@ class RedStar(AutoShardedClient):
         await self.plugin_manager.hook_event("on_raw_reaction_remove", payload)
 
     async def on_reaction_clear(self, message, reactions):
-        if message.guild is None:
+        if not self.plugin_manager.has_subscribers("on_reaction_clear") or message.guild is None:
             return
         if self.channel_manager.channel_in_category(message.guild, "no_read", message.channel):
             return
@@ -160,23 +166,32 @@ class RedStar(AutoShardedClient):
         await self.plugin_manager.hook_event("on_guild_channel_create", channel)
 
     async def on_guild_channel_delete(self, channel):
+        self.command_dispatcher.invalidate_permissions(channel.guild.id)
         await self.plugin_manager.hook_event("on_guild_channel_delete", channel)
 
     async def on_guild_channel_update(self, before, after):
+        if before.overwrites != after.overwrites or before.category_id != after.category_id:
+            self.command_dispatcher.invalidate_permissions(after.guild.id)
         await self.plugin_manager.hook_event("on_guild_channel_update", before, after)
 
     async def on_guild_channel_pins_update(self, channel, last_pin):
+        if not self.plugin_manager.has_subscribers("on_guild_channel_pins_update"):
+            return
         if self.channel_manager.channel_in_category(channel.guild, "no_read", channel):
             return
         await self.plugin_manager.hook_event("on_guild_channel_pins_update", channel, last_pin)
 
     async def on_member_join(self, member):
+        self.command_dispatcher.invalidate_permissions(member.guild.id, member.id)
         await self.plugin_manager.hook_event("on_member_join", member)
 
     async def on_member_remove(self, member):
+        self.command_dispatcher.invalidate_permissions(member.guild.id, member.id)
         await self.plugin_manager.hook_event("on_member_remove", member)
 
     async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.command_dispatcher.invalidate_permissions(after.guild.id, after.id)
         await self.plugin_manager.hook_event("on_member_update", before, after)
 
     async def on_guild_join(self, guild):
@@ -184,18 +199,23 @@ class RedStar(AutoShardedClient):
         await self.plugin_manager.hook_event("on_guild_join", guild)
 
     async def on_guild_remove(self, guild):
+        self.command_dispatcher.forget_guild(guild.id)
         await self.plugin_manager.hook_event("on_guild_remove", guild)
 
     async def on_guild_update(self, before, after):
+        if before.owner_id != after.owner_id:
+            self.command_dispatcher.invalidate_permissions(after.id)
         await self.plugin_manager.hook_event("on_guild_update", before, after)
 
     async def on_guild_role_create(self, role):
         await self.plugin_manager.hook_event("on_guild_role_create", role)
 
     async def on_guild_role_delete(self, role):
+        self.command_dispatcher.invalidate_permissions(role.guild.id)
         await self.plugin_manager.hook_event("on_guild_role_delete", role)
 
     async def on_guild_role_update(self, before, after):
+        self.command_dispatcher.invalidate_permissions(after.guild.id)
         await self.plugin_manager.hook_event("on_guild_role_update", before, after)
 
     async def on_guild_emojis_update(self, guild, before, after):
@@ -1,11 +1,19 @@
 import inspect
 import logging
+import re
 from asyncio import sleep
+from collections import OrderedDict
+from math import ceil
 from sys import exc_info
+from red_star.command_scheduler import CommandScheduler
+from red_star.rate_limiter import RateLimiter
 from red_star.rs_errors import ChannelNotFoundError, CommandSyntaxError, UserPermissionError
-from discord import Forbidden
+from discord import Forbidden, Permissions
 from red_star.rs_utils import respond, sub_user_data
 
+# The first word of a message after its prefix; only that much of the message is scanned
+_token_regex = re.compile(r"\s*(\S+)")
+
 
 class CommandDispatcher:
     def __init__(self, client):
@@ -21,6 +29,23 @@ class CommandDispatcher:
 
         self.commands = {}
         self.last_error = None
+        # kind -> function of a guild returning that guild's prefix for the kind, or None if it has none
+        self.prefix_providers = {"command": lambda guild: self.conf[self._init_guild(guild)]["command_prefix"]}
+        # guild ID -> (first characters of the prefixes, ((prefix, kind), ...)), built when first needed
+        self._prefix_tables = {}
+        # message ID -> classification, for the messages that are being handled right now
+        self._classified = OrderedDict()
+        # (guild ID, guild version, channel ID or 0 for guild-wide, member ID) -> permission bits
+        self._permissions = OrderedDict()
+        self._permission_cache_size = self.config_manager.config.get("permission_cache_size", 1024)
+        # Bumping a guild's version makes the permissions cached with the old one unreachable
+        self._guild_versions = {}
+        self.rate_limiter = RateLimiter(self.config_manager.config.get("rate_limits", {}).get("idle_expiry", 600))
+        scheduler_conf = self.config_manager.config.get("command_scheduler", {})
+        self.scheduler = CommandScheduler(concurrency=scheduler_conf.get("concurrency", 8),
+                                          guild_concurrency=scheduler_conf.get("guild_concurrency", 2),
+                                          max_queued_per_guild=scheduler_conf.get("max_queued_per_guild", 20),
+                                          max_priority_queued=scheduler_conf.get("max_priority_queued", 50))
 
     def register_plugin(self, plugin):
         for _, mth in inspect.getmembers(plugin, predicate=inspect.ismethod):
@@ -82,6 +107,182 @@ class CommandDispatcher:
             for alias in fn.aliases:
                 self.deregister(fn, alias, is_alias=True)
 
+    def register_prefix(self, kind, provider):
+        """
+        Registers a kind of prefixed message for classify to recognise, such as the custom command prefix.
+        :param kind: The name the kind is reported under by classify.
+        :param provider: A function that takes a guild and returns its prefix for this kind, or None if it has none.
+        The prefix is cached until invalidate_prefixes is called, so the function may be expensive.
+        :return: None.
+        """
+        self.prefix_providers[kind] = provider
+        self.invalidate_prefixes()
+
+    def deregister_prefix(self, kind):
+        self.prefix_providers.pop(kind, None)
+        self.invalidate_prefixes()
+
+    def invalidate_prefixes(self, guild_id=None):
+        """
+        Forgets the cached prefixes, so that they're looked up again. Needs to be called whenever a prefix is changed.
+        :param guild_id: The ID of the guild whose prefixes changed, or None for every guild.
+        :return: None.
+        """
+        if guild_id is None:
+            self._prefix_tables.clear()
+        else:
+            self._prefix_tables.pop(int(guild_id), None)
+        self._classified.clear()
+
+    def classify(self, msg):
+        """
+        Finds out which kinds of prefixed message a message is, and extracts the word following each matching prefix.
+        The result is cached for the message, so every plugin routing on it shares the work.
+        :param msg: The message to classify.
+        :return: A dict of kind -> lowercased word after that kind's prefix. Empty for ordinary messages and for the
+        bot's own messages.
+        """
+        try:
+            return self._classified[msg.id]
+        except KeyError:
+            pass
+        result = {}
+        cnt = msg.content
+        if cnt and msg.author != self.client.user:
+            first_chars, prefixes = self._get_prefix_table(msg.guild)
+            if cnt[0] in first_chars:
+                for prefix, kind in prefixes:
+                    if cnt.startswith(prefix):
+                        token = _token_regex.match(cnt, len(prefix))
+                        if token:
+                            result[kind] = token.group(1).lower()
+        self._classified[msg.id] = result
+        if len(self._classified) > 64:
+            self._classified.popitem(last=False)
+        return result
+
+    def _get_prefix_table(self, guild):
+        guild_id = guild.id if guild is not None else None
+        try:
+            return self._prefix_tables[guild_id]
+        except KeyError:
+            pass
+        if guild is None:
+            # Only commands work in DMs, with the default prefix
+            prefixes = (("!", "command"),)
+        else:
+            prefixes = []
+            for kind, provider in self.prefix_providers.items():
+                prefix = provider(guild)
+                if prefix:
+                    prefixes.append((prefix, kind))
+            prefixes = tuple(prefixes)
+        table = self._prefix_tables[guild_id] = (frozenset(prefix[0] for prefix, _ in prefixes), prefixes)
+        return table
+
+    def get_permissions(self, member, channel=None):
+        """
+        Looks up a member's permissions, caching them until invalidate_permissions is called for the member or guild.
+        :param member: The member whose permissions to get.
+        :param channel: The channel to get the permissions in, or None for the member's guild-wide permissions.
+        :return: The permissions, as the bits of a discord.Permissions value.
+        """
+        gid = member.guild.id
+        key = (gid, self._guild_versions.get(gid, 0), channel.id if channel is not None else 0, member.id)
+        try:
+            value = self._permissions[key]
+            self._permissions.move_to_end(key)
+        except KeyError:
+            perms = member.permissions_in(channel) if channel is not None else member.guild_permissions
+            value = self._permissions[key] = perms.value
+            if len(self._permissions) > self._permission_cache_size:
+                self._permissions.popitem(last=False)
+        return value
+
+    def has_permissions(self, msg, perm_mask):
+        """
+        Checks whether a message's author has a set of permissions, in the message's channel or in the voice channel
+        the bot is connected to in that guild.
+        :param msg: The message, sent in a guild.
+        :param perm_mask: The bits of the required discord.Permissions value.
+        :return: True if the author has every one of the permissions.
+        """
+        perms = self.get_permissions(msg.author, msg.channel)
+        if perms & perm_mask != perm_mask and msg.guild.voice_client:
+            perms |= self.get_permissions(msg.author, msg.guild.voice_client.channel)
+        return perms & perm_mask == perm_mask
+
+    def invalidate_permissions(self, guild_id, member_id=None):
+        """
+        Forgets cached permissions after a change to a guild's roles or channels, or to a member's roles or
+        membership.
+        :param guild_id: The ID of the guild that changed.
+        :param member_id: The ID of the member that changed, or None to forget every member of the guild.
+        :return: None.
+        """
+        if member_id is None:
+            self._guild_versions[guild_id] = self._guild_versions.get(guild_id, 0) + 1
+        else:
+            # Member changes are rare enough to look through the cache for, rather than keeping a version per member
+            for key in [key for key in self._permissions if key[3] == member_id and key[0] == guild_id]:
+                del self._permissions[key]
+
+    def forget_guild(self, guild_id):
+        """
+        Drops everything cached about a guild the bot left.
+        :param guild_id: The ID of the guild.
+        :return: None.
+        """
+        for key in [key for key in self._permissions if key[0] == guild_id]:
+            del self._permissions[key]
+        self._guild_versions.pop(guild_id, None)
+        self._prefix_tables.pop(guild_id, None)
+
+    def check_rate_limit(self, msg, name, category, rate_limit=None):
+        """
+        Spends a token from each rate limit bucket that applies to a guild message: the user's buckets for the
+        command, its category and all their commands, and the guild's bucket. Limits come from the "rate_limits"
+        config, where a guild's entry in "guilds" overrides the global ones, and the command's own rate_limit is the
+        fallback for its command limit. Bot maintainers aren't limited.
+        :param msg: The message invoking the command.
+        :param name: The command's name.
+        :param category: The command's category.
+        :param rate_limit: The command's default limit, as (uses, seconds), or None.
+        :return: A tuple of the seconds to wait before trying again (0 if the command may run), and whether the
+        cooldown should be announced.
+        """
+        conf = self.config_manager.config.get("rate_limits", {})
+        if not conf.get("enabled", True) or self.config_manager.is_maintainer(msg.author):
+            return 0, False
+        gid = msg.guild.id
+        uid = msg.author.id
+        guild_conf = conf.get("guilds", {}).get(str(gid), {})
+        limits = (
+            (("command", gid, uid, name),
+             guild_conf.get("commands", {}).get(name) or conf.get("commands", {}).get(name) or rate_limit),
+            (("category", gid, uid, category),
+             guild_conf.get("categories", {}).get(category) or conf.get("categories", {}).get(category)),
+            (("user", gid, uid), guild_conf.get("user", conf.get("user"))),
+            (("guild", gid), guild_conf.get("guild", conf.get("guild")))
+        )
+        return self.rate_limiter.acquire(((key, limit) for key, limit in limits if limit), name=name)
+
+    async def rate_limited(self, msg, name, category, rate_limit=None):
+        """
+        Checks the rate limits of a guild message with check_rate_limit, telling the user when they hit one.
+        :return: True if the command may not run.
+        """
+        retry_after, announce = self.check_rate_limit(msg, name, category, rate_limit)
+        if retry_after and announce:
+            await respond(msg, f"**WARNING: Rate limit reached. Try again in {ceil(retry_after)} seconds.**")
+        return bool(retry_after)
+
+    def _init_guild(self, guild):
+        gid = str(guild.id)
+        if gid not in self.conf:
+            self.conf[gid] = self.default_config.copy()
+        return gid
+
     # noinspection PyBroadException
     async def run_command(self, command, msg, dm_cmd=False):
         try:
@@ -89,7 +290,7 @@ class CommandDispatcher:
         except KeyError:
             return
         if dm_cmd:
-            if msg.author.id not in self.config_manager.config.get("bot_maintainers", []):
+            if not self.config_manager.is_maintainer(msg.author):
                 return
             if not fn.dm_command:
                 return
@@ -109,13 +310,6 @@ class CommandDispatcher:
         else:
             gid = str(msg.guild.id)
             try:
-                if not fn.run_anywhere:
-                    try:
-                        cmd_channel = self.client.channel_manager.get_channel(msg.guild, "commands")
-                        if msg.channel != cmd_channel:
-                            return
-                    except ChannelNotFoundError:
-                        pass
                 await fn(msg)
                 if fn.delcall:
                     await sleep(1)
@@ -146,32 +340,55 @@ class CommandDispatcher:
     # Event hooks
 
     async def command_check(self, msg):
+        cmd = self.classify(msg).get("command")
         try:
-            gid = str(msg.guild.id)
-            if gid not in self.conf:
-                self.conf[gid] = self.default_config.copy()
-            deco = self.conf[gid]["command_prefix"]
-            dm_cmd = False
-        except AttributeError:  # Oops, it's a DM isn't it
-            deco = "!"
-            dm_cmd = True
-        if msg.author != self.client.user:
-            cnt = msg.content
-            if cnt.startswith(deco):
-                cmd = cnt[len(deco):].split()[0].lower()
-                if cmd in self.commands:
-                    await self.run_command(cmd, msg, dm_cmd=dm_cmd)
+            fn = self.commands[cmd]
+        except KeyError:
+            return
+        if msg.guild is None:
+            # Only maintainers may use DM commands, so nobody else gets to take a slot in the priority lane
+            if not fn.dm_command or not self.config_manager.is_maintainer(msg.author):
+                return
+        elif not fn.run_anywhere:
+            try:
+                if msg.channel != self.client.channel_manager.get_channel(msg.guild, "commands"):
+                    return
+            except ChannelNotFoundError:
+                pass
+        await self.schedule(msg, lambda: self.run_command(cmd, msg, dm_cmd=msg.guild is None),
+                            fn.name.lower(), fn.category, fn.rate_limit)
+
+    async def schedule(self, msg, job, name=None, category=None, rate_limit=None):
+        """
+        Hands a command off to the scheduler, to be run when there's room. Commands sent by bot maintainers skip ahead
+        of the guilds' queues; other DMs are queued together, like a guild of their own. Guild commands are rate
+        limited before they're queued, so that a user spamming a command can't fill their guild's queue.
+        :param msg: The message that invoked the command.
+        :param job: A function taking no arguments that returns the coroutine running the command.
+        :param name: The command's name, to rate limit it under; None to skip the rate limits.
+        :param category: The command's category, for its rate limits.
+        :param rate_limit: The command's default limit, as (uses, seconds), or None.
+        :return: False if the command was refused by a rate limit, or dropped because the guild already had too many
+        commands waiting.
+        """
+        if msg.guild is not None and name is not None and await self.rate_limited(msg, name, category, rate_limit):
+            return False
+        queued = self.scheduler.submit(msg.guild and msg.guild.id, job,
+                                       priority=self.config_manager.is_maintainer(msg.author))
+        if not queued:
+            self.logger.debug(f"Dropped command from {msg.author} in {msg.guild}, too many commands queued.")
+        return queued
 
 
 class Command:
     """
     Defines a decorator that encapsulates a chat command. Provides a common
     interface for all commands, including roles, documentation, usage syntax,
-    and aliases.
+    aliases and rate limits.
     """
 
     def __init__(self, name, *aliases, perms=None, doc=None, syntax=None, priority=0, delcall=False,
-                 run_anywhere=False, bot_maintainers_only=False, dm_command=False, category="other"):
+                 run_anywhere=False, bot_maintainers_only=False, dm_command=False, category="other", rate_limit=None):
         if syntax is None:
             syntax = ()
         if isinstance(syntax, str):
@@ -184,6 +401,8 @@ class Command:
         if isinstance(perms, str):
             perms = {perms}
         self.perms = perms
+        # Unknown permission names raise TypeError here, when the plugin is loaded
+        self.perm_mask = Permissions(**{perm: True for perm in perms}).value
         self.syntax = syntax
         self.human_syntax = " ".join(syntax)
         self.doc = doc
@@ -194,6 +413,8 @@ class Command:
         self.category = category
         self.bot_maintainers_only = bot_maintainers_only
         self.dm_command = dm_command
+        # (uses, seconds) allowed per user, unless the rate_limits config overrides it
+        self.rate_limit = rate_limit
 
     def __call__(self, f):
         """
@@ -206,11 +427,9 @@ class Command:
         async def wrapped(s, msg):
             if msg.guild is None and self.dm_command:  # The permission check was handled pre-call.
                 return await f(s, msg)
-            user_perms = {x for x, y in msg.author.permissions_in(msg.channel) if y}
-            if msg.guild.voice_client:
-                user_perms |= {x for x, y in msg.author.permissions_in(msg.guild.voice_client.channel) if y}
-            if (not user_perms >= self.perms or self.bot_maintainers_only) \
-                    and msg.author.id not in s.config_manager.config.get("bot_maintainers", []):
+            if (self.bot_maintainers_only
+                    or self.perm_mask and not s.client.command_dispatcher.has_permissions(msg, self.perm_mask)) \
+                    and not s.config_manager.is_maintainer(msg.author):
                 raise UserPermissionError
             return await f(s, msg)
         wrapped._command = True
@@ -218,10 +437,12 @@ class Command:
         wrapped.__doc__ = self.doc
         wrapped.name = self.name
         wrapped.perms = self.perms
+        wrapped.perm_mask = self.perm_mask
         wrapped.syntax = self.human_syntax
         wrapped.priority = self.priority
         wrapped.delcall = self.delcall
         wrapped.run_anywhere = self.run_anywhere
         wrapped.dm_command = self.dm_command
         wrapped.category = self.category
+        wrapped.rate_limit = self.rate_limit
         return wrapped
@@ -0,0 +1,121 @@
+import logging
+from asyncio import create_task
+from collections import deque, OrderedDict
+from time import monotonic
+
+
+class CommandScheduler:
+    """
+    Runs commands as tasks, with a limit on how many run at once. Waiting commands are queued per guild, and the
+    queues are served round-robin, so a guild flooding commands only delays its own. Commands in the priority lane
+    (maintainers') are started before any guild's.
+    """
+
+    def __init__(self, concurrency=8, guild_concurrency=2, max_queued_per_guild=20, max_priority_queued=50):
+        """
+        :param concurrency: The maximum number of commands running at once.
+        :param guild_concurrency: The maximum number of one guild's commands running at once.
+        :param max_queued_per_guild: The maximum number of one guild's commands waiting to run.
+        :param max_priority_queued: The maximum number of priority commands waiting to run.
+        """
+        self.concurrency = concurrency
+        self.guild_concurrency = guild_concurrency
+        self.max_queued_per_guild = max_queued_per_guild
+        self.max_priority_queued = max_priority_queued
+        self.logger = logging.getLogger("red_star.command_scheduler")
+        self.priority_queue = deque()
+        # guild ID -> GuildQueue, in the order the guilds are to be served
+        self.guild_queues = OrderedDict()
+        self.running = 0
+        self.tasks = set()
+        self.stats = {"submitted": 0, "completed": 0, "dropped": 0, "max_depth": 0, "total_wait": 0.0,
+                      "max_wait": 0.0}
+
+    def submit(self, guild_id, job, priority=False):
+        """
+        Queues a command to be run.
+        :param guild_id: The ID of the guild the command was sent in, to queue it with that guild's commands.
+        :param job: A function taking no arguments that returns the coroutine to run.
+        :param priority: Whether to run the command before any guild's.
+        :return: False if the queue was full and the command was dropped, True otherwise.
+        """
+        self.stats["submitted"] += 1
+        entry = (monotonic(), job)
+        if priority:
+            if len(self.priority_queue) >= self.max_priority_queued:
+                self.stats["dropped"] += 1
+                return False
+            self.priority_queue.append(entry)
+        else:
+            try:
+                queue = self.guild_queues[guild_id]
+            except KeyError:
+                queue = self.guild_queues[guild_id] = GuildQueue()
+            if len(queue.jobs) >= self.max_queued_per_guild:
+                self.stats["dropped"] += 1
+                return False
+            queue.jobs.append(entry)
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(queue.jobs))
+        self._start_jobs()
+        return True
+
+    def queued(self):
+        """
+        :return: A dict of guild ID -> number of its commands waiting to run, for the guilds with any waiting.
+        """
+        return {gid: len(queue.jobs) for gid, queue in self.guild_queues.items() if queue.jobs}
+
+    def close(self):
+        """
+        Drops every waiting command. Running ones are left to finish, since one of them may be the one closing it.
+        """
+        self.priority_queue.clear()
+        for queue in self.guild_queues.values():
+            queue.jobs.clear()
+
+    def _start_jobs(self):
+        while self.running < self.concurrency:
+            if self.priority_queue:
+                guild_id = queue = None
+                queued_at, job = self.priority_queue.popleft()
+            else:
+                for guild_id, queue in self.guild_queues.items():
+                    if queue.jobs and queue.running < self.guild_concurrency:
+                        break
+                else:
+                    return
+                queued_at, job = queue.jobs.popleft()
+                queue.running += 1
+                # this guild goes to the back of the line
+                self.guild_queues.move_to_end(guild_id)
+            wait = monotonic() - queued_at
+            self.stats["total_wait"] += wait
+            self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+            self.running += 1
+            task = create_task(self._run(guild_id, queue, job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    # noinspection PyBroadException
+    async def _run(self, guild_id, queue, job):
+        try:
+            await job()
+        except Exception:
+            self.logger.exception("Exception occurred in scheduled command. ", exc_info=True)
+        finally:
+            self.running -= 1
+            self.stats["completed"] += 1
+            # Priority commands don't count against any guild, including DMs queued under the guild ID None
+            if queue is not None:
+                queue.running -= 1
+                if not queue.jobs and not queue.running:
+                    del self.guild_queues[guild_id]
+            self._start_jobs()
+
+
+class GuildQueue:
+    __slots__ = ("jobs", "running")
+
+    def __init__(self):
+        self.jobs = deque()
+        self.running = 0
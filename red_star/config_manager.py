@@ -1,9 +1,11 @@
 import json
 import logging
 import sys
+from fnmatch import fnmatch
 from pathlib import Path
 from shutil import copyfile
 from red_star.rs_utils import JsonFileDict
+from red_star.sqlite_storage import SqliteFileDict
 
 
 class ConfigManager:
@@ -17,6 +19,7 @@ class ConfigManager:
         self.config_path = config_path
         self.config_file_path = config_path / "config.json"
         self.plugin_config_files = {}
+        self._maintainers = None
         self.load_config()
 
     def load_config(self):
@@ -51,6 +54,7 @@ class ConfigManager:
 
         if "plugins" not in self.config:
             self.config["plugins"] = {}
+        self._maintainers = None
 
     def save_config(self):
         temp_path = Path(str(self.config_file_path) + "_bak")
@@ -58,6 +62,8 @@ class ConfigManager:
             json.dump(self.config, f, sort_keys=True, indent=2)
         self.config_file_path.unlink()
         temp_path.rename(self.config_file_path)
+        # bot_maintainers may have been edited
+        self._maintainers = None
         for file in self.plugin_config_files.values():
             file.save()
         self.logger.debug("Saved config files.")
@@ -74,13 +80,38 @@ class ConfigManager:
         new_config.update(current_config)
         self.config["plugins"][name] = new_config
 
-    def get_plugin_config_file(self, filename, json_save_args=None, json_load_args=None) -> JsonFileDict:
+    def get_plugin_config_file(self, filename, json_save_args=None, json_load_args=None, backend=None,
+                               write_delay=None) -> (JsonFileDict, SqliteFileDict):
+        """
+        Loads a plugin's data file, or returns the already loaded one.
+        :param filename: The name of the file, relative to the config directory.
+        :param json_save_args: Keyword arguments for json.dumps when saving.
+        :param json_load_args: Keyword arguments for json.loads when loading.
+        :param backend: "json" or "sqlite". If None, the "storage_backends" section of config.json decides, and
+        files it doesn't mention are JSON.
+        :param write_delay: The number of seconds to coalesce saves to the file for. If None, the file_write_delay
+        option of config.json decides.
+        :return: A JsonFileDict, or an SqliteFileDict for files stored in SQLite. The latter keeps its data in
+        a .sqlite file next to where the JSON file would be, imported from the JSON file when first created. Both
+        apply json_load_args to the file's top-level object, so the same hooks work with either.
+        """
         if filename in self.plugin_config_files:
-            file_obj = self.plugin_config_files[filename]
+            return self.plugin_config_files[filename]
+        file_path = self.config_path / filename
+        default_config = Path.cwd() / "_default_files" / (filename + ".default")
+        if write_delay is None:
+            write_delay = self.config.get("file_write_delay", 0)
+        if backend is None:
+            backend = self.get_storage_backend(filename)
+        if backend == "sqlite":
+            db_path = file_path.with_suffix(".sqlite")
+            new_db = not db_path.exists()
+            file_obj = SqliteFileDict(db_path, json_save_args, json_load_args, write_delay=write_delay)
+            if new_db and (file_path.exists() or default_config.exists()):
+                file_obj.import_json(file_path if file_path.exists() else default_config)
+                self.logger.info(f"Imported {filename} into {db_path}.")
         else:
-            file_path = self.config_path / filename
             if not file_path.exists():
-                default_config = Path.cwd() / "_default_files" / (filename + ".default")
                 if default_config.exists():
                     copyfile(str(default_config), str(file_path))
                     self.logger.debug(f"Copied default configuration for {filename} to {file_path}.")
@@ -88,9 +119,41 @@ class ConfigManager:
                     with file_path.open("w", encoding="utf-8") as fd:
                         fd.write("{}")
                     self.logger.debug(f"Created config file {file_path}.")
-            file_obj = JsonFileDict(file_path, json_save_args, json_load_args)
-            self.plugin_config_files[filename] = file_obj
+            file_obj = JsonFileDict(file_path, json_save_args, json_load_args, write_delay=write_delay)
+        self.plugin_config_files[filename] = file_obj
         return file_obj
 
+    def get_storage_backend(self, filename):
+        """
+        :param filename: The name of a plugin config file.
+        :return: The backend config.json's "storage_backends" section sets for the file, matched by name first and
+        by fnmatch pattern second, or "json" if it isn't set.
+        """
+        backends = self.config.get("storage_backends", {})
+        try:
+            return backends[filename]
+        except KeyError:
+            for pattern, backend in backends.items():
+                if fnmatch(filename, pattern):
+                    return backend
+        return "json"
+
+    async def flush_config_files(self):
+        """
+        Writes out every plugin config file with pending write-behind changes. Called on shutdown.
+        """
+        for file in self.plugin_config_files.values():
+            await file.flush_async()
+        self.logger.debug("Flushed config files.")
+
+    @property
+    def maintainers(self):
+        """
+        The IDs of the bot maintainers, as a frozenset. Rebuilt from the config after it's loaded or saved.
+        """
+        if self._maintainers is None:
+            self._maintainers = frozenset(self.config.get('bot_maintainers', []))
+        return self._maintainers
+
     def is_maintainer(self, member):
-        return member.id in self.config.get('bot_maintainers', [])
+        return member.id in self.maintainers
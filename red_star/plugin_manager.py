@@ -2,6 +2,7 @@ import inspect
 import logging
 import importlib
 import importlib.util
+from asyncio import create_task, gather, get_running_loop, wait_for, TimeoutError
 from sys import exc_info, modules
 from types import ModuleType
 
@@ -19,6 +20,7 @@ class PluginManager:
         self.modules = {}
         self.plugins = {}
         self.active_plugins = {}
+        self.event_handlers = {}
         self.logger = logging.getLogger("red_star.plugin_manager")
         self.logger.debug("Initialized plugin manager.")
         self.last_error = None
@@ -106,6 +108,7 @@ class PluginManager:
                     self.command_dispatcher.register_plugin(plugin)
                 except Exception:
                     self.logger.exception(f"Error occurred while activating plugin {plugin.name}: ", exc_info=True)
+        self._rebuild_event_index()
         await self.hook_event("on_all_plugins_loaded")
 
     async def deactivate_all(self):
@@ -120,6 +123,7 @@ class PluginManager:
                     self.logger.exception(f"Error occurred while deactivating plugin {plugin.name}: ", exc_info=True)
                 del self.active_plugins[n]
                 self.command_dispatcher.deregister_plugin(plugin)
+        self._rebuild_event_index()
 
     async def activate(self, name):
         try:
@@ -131,6 +135,7 @@ class PluginManager:
                     await plg.activate()
                     self.active_plugins[name] = plg
                     self.command_dispatcher.register_plugin(plg)
+                    self._rebuild_event_index()
                     await self.hook_event("on_plugin_activated", name)
                 except Exception:
                     self.logger.exception(f"Error occurred while activating plugin {name}: ", exc_info=True)
@@ -151,6 +156,7 @@ class PluginManager:
                     self.logger.exception(f"Error occurred while deactivating plugin {name}: ", exc_info=True)
                 del self.active_plugins[name]
                 self.command_dispatcher.deregister_plugin(plg)
+                self._rebuild_event_index()
                 await self.hook_event("on_plugin_deactivated", name)
             else:
                 self.logger.warning(f"Attempted to deactivate already inactive plugin {name}.")
@@ -173,24 +179,107 @@ class PluginManager:
         except KeyError:
             self.logger.error(f"Attempted to reload non-existent plugin module {name}.")
 
+    def _rebuild_event_index(self):
+        """
+        Rebuilds the event name -> handler index from the active plugins. Must be called whenever the set of
+        active plugins changes, so that hook_event only has to do a single lookup per dispatch.
+        """
+        index = {}
+        for plugin in self.active_plugins.values():
+            for name in dir(type(plugin)):
+                # Looked up statically first, so that properties and other descriptors aren't evaluated
+                if name.startswith("on_") and inspect.isfunction(inspect.getattr_static(plugin, name)):
+                    index.setdefault(name, []).append((plugin, getattr(plugin, name)))
+        self.event_handlers = index
+
+    def has_subscribers(self, event):
+        """
+        Checks whether any active plugin handles the given event, so callers can skip preparing it entirely.
+        :param event: The name of the event.
+        :return: True if at least one active plugin has a hook for the event.
+        """
+        return event in self.event_handlers
+
     async def hook_event(self, event, *args, **kwargs):
         """
         Dispatches an event, with its data, to all plugins.
+        Each plugin's hook runs as its own task, so a slow or failing plugin can't hold up the others. Plugins
+        listed in the ordered_event_plugins config option have their hooks run one after another instead, in
+        activation order, alongside the concurrent ones.
         :param event: The name of the event. Should match the calling function.
         :param args: Everything that gets passed to the calling function
         should be passed through to this function.
         """
-        plugins = set(self.active_plugins.values())
-        for plugin in plugins:
-            hook = getattr(plugin, event, False)
-            if hook:
-                # noinspection PyBroadException
-                try:
-                    await hook(*args, **kwargs)
-                except Exception:
-                    self.last_error = exc_info()
-                    self.logger.exception(f"Exception encountered in plugin {plugin.name} on event {event}: ",
-                                          exc_info=True)
+        handlers = self.event_handlers.get(event)
+        if not handlers:
+            return
+        config = self.config_manager.config
+        if not config.get("concurrent_event_dispatch", True):
+            for plugin, hook in handlers:
+                await self._run_hook(plugin, event, hook, args, kwargs)
+            return
+        ordered_names = config.get("ordered_event_plugins", [])
+        ordered_hooks = []
+        tasks = []
+        for plugin, hook in handlers:
+            if plugin.name in ordered_names:
+                ordered_hooks.append((plugin, hook))
+            else:
+                tasks.append(create_task(self._run_hook(plugin, event, hook, args, kwargs)))
+        if ordered_hooks:
+            tasks.append(create_task(self._run_ordered_hooks(event, ordered_hooks, args, kwargs)))
+        if tasks:
+            await gather(*tasks)
+
+    async def _run_ordered_hooks(self, event, hooks, args, kwargs):
+        for plugin, hook in hooks:
+            await self._run_hook(plugin, event, hook, args, kwargs)
+
+    async def _run_hook(self, plugin, event, hook, args, kwargs):
+        """
+        Runs a single plugin hook, making sure any exception is logged rather than propagated to the other hooks of
+        the event. A hook running longer than the slow_event_hook_warning config option is logged, but left to
+        finish. Hooks are only cancelled if the event_hook_timeouts config option gives them a timeout, keyed by
+        "plugin_name.on_event", "plugin_name" or "on_event", with the most specific key used.
+        """
+        config = self.config_manager.config
+        timeout = self._get_hook_timeout(config.get("event_hook_timeouts", {}), plugin.name, event)
+        slow_time = config.get("slow_event_hook_warning", 60)
+        warning = None
+        if slow_time:
+            warning = get_running_loop().call_later(slow_time, self.logger.warning,
+                                                    f"Plugin {plugin.name} has been running for over {slow_time} "
+                                                    f"seconds on event {event}.")
+        # noinspection PyBroadException
+        try:
+            if timeout:
+                await wait_for(hook(*args, **kwargs), timeout)
+            else:
+                await hook(*args, **kwargs)
+        except TimeoutError:
+            self.logger.warning(f"Plugin {plugin.name} timed out after {timeout} seconds on event {event}.")
+        except Exception:
+            self.last_error = exc_info()
+            self.logger.exception(f"Exception encountered in plugin {plugin.name} on event {event}: ",
+                                  exc_info=True)
+        finally:
+            if warning is not None:
+                warning.cancel()
+
+    @staticmethod
+    def _get_hook_timeout(timeouts, plugin_name, event):
+        """
+        :param timeouts: The event_hook_timeouts config option.
+        :param plugin_name: The name of the plugin the hook belongs to.
+        :param event: The name of the event.
+        :return: The number of seconds after which to cancel the hook, or None to never cancel it.
+        """
+        if not timeouts:
+            return None
+        for key in (f"{plugin_name}.{event}", plugin_name, event):
+            if key in timeouts:
+                return timeouts[key] or None
+        return None
 
 
 class BasePlugin:
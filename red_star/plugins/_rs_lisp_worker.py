@@ -0,0 +1,132 @@
+"""
+Sandbox worker for the custom_commands plugin. Evaluates RSLisp programs in a separate process, so that a runaway
+custom command can be killed without freezing the bot.
+
+Reads one JSON request per line from stdin and writes one JSON reply per line to stdout. Side effects that need
+the discord machinery (embeds, deleting the calling message) are sent back to the bot in the reply.
+"""
+import json
+import sys
+import traceback
+from argparse import ArgumentParser
+from collections import OrderedDict
+from pathlib import Path
+from rs_lisp import lisp_compile, parse, standard_env, get_args, has_mutable_literals
+from red_star.rs_errors import CommandSyntaxError, CustomCommandSyntaxError
+
+try:
+    import resource
+except ImportError:  # not available on Windows, where only the wall-clock limit applies
+    resource = None
+
+
+class Worker:
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        # program text -> (AST, compiled program or None if it has to be compiled from a fresh copy every run)
+        self.cache = OrderedDict()
+
+    def get_program(self, content):
+        try:
+            ast, program = self.cache[content]
+            self.cache.move_to_end(content)
+        except KeyError:
+            ast = parse(content)
+            program = lisp_compile(ast) if not has_mutable_literals(ast) else None
+            self.cache[content] = (ast, program)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return program if program is not None else lisp_compile(parse(content))
+
+    def run(self, request):
+        effects = []
+        max_runtime = request.get("max_runtime", 0)
+        limit_cpu(max_runtime)
+
+        env = standard_env(max_runtime=max_runtime)
+        env.update(request["env"])
+        roles = request.get("roles", [])
+        ccfolder = Path(request["ccfolder"]) if request.get("ccfolder") else None
+        env['hasrole'] = lambda *x: hasrole(roles, *x)
+        env['delcall'] = lambda: effects.append(["delcall"])
+        env['embed'] = lambda *x: effects.append(["embed", [*get_args(x)[1].items()]])
+        env['file'] = lambda x: read_file(ccfolder, x)
+
+        reply = {"output": "", "result": "", "effects": effects, "error": None}
+        try:
+            res = self.get_program(request["program"])(env)
+            reply["output"] = str(env['_rsoutput'])
+            reply["result"] = str(res) if res else ""
+        except CustomCommandSyntaxError as e:
+            reply["error"] = {"kind": "cc_syntax", "message": str(e)}
+        except CommandSyntaxError as e:
+            reply["error"] = {"kind": "syntax", "message": str(e)}
+        except MemoryError:
+            reply["error"] = {"kind": "cc_syntax", "message": "The command used too much memory."}
+        except Exception as e:
+            reply["error"] = {"kind": "error", "message": str(e), "traceback": traceback.format_exc()}
+        return reply
+
+
+def limit_cpu(seconds):
+    # RLIMIT_CPU counts the CPU time of the whole process, so the soft limit is moved past what was used so far.
+    # Going over it gets the worker killed by SIGXCPU, which the bot reports as the command running too long.
+    if resource is None or not seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def limit_memory(limit):
+    if resource is None or not limit:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def hasrole(roles, *args):
+    _args = map(str.lower, args)
+    return any([x.lower() in _args for x in roles])
+
+
+def read_file(ccfolder, filename):
+    if not filename.isidentifier() or ccfolder is None:
+        raise CustomCommandSyntaxError(f"file error: illegal filename {filename}")
+    try:
+        with (ccfolder / (filename + '.json')).open() as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        raise CustomCommandSyntaxError(f"file error: no file named {filename}")
+    except json.decoder.JSONDecodeError:
+        raise CustomCommandSyntaxError(f"json error: file {filename} is invalid json")
+
+
+def main():
+    parser = ArgumentParser(description="Evaluates RSLisp programs sent over stdin.")
+    parser.add_argument("--memory-limit", type=int, default=0, help="Address space limit of the worker, in bytes.")
+    parser.add_argument("--cache-size", type=int, default=256, help="Number of compiled programs to keep.")
+    args = parser.parse_args()
+
+    limit_memory(args.memory_limit)
+    # nothing but replies may end up on stdout
+    channel = sys.stdout
+    sys.stdout = sys.stderr
+    worker = Worker(args.cache_size)
+    for line in sys.stdin:
+        try:
+            reply = json.dumps(worker.run(json.loads(line)), default=str)
+        except Exception as e:
+            reply = json.dumps({"output": "", "result": "", "effects": [],
+                                "error": {"kind": "error", "message": str(e), "traceback": traceback.format_exc()}})
+        channel.write(reply + "\n")
+        channel.flush()
+
+
+if __name__ == "__main__":
+    main()
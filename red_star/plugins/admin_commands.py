@@ -23,7 +23,8 @@ class AdminCommands(BasePlugin):
              run_anywhere=True,
              delcall=True,
              perms={"manage_messages"},
-             category="admin")
+             category="admin",
+             rate_limit=(2, 10))
     async def _purge(self, msg):
 
         parser = RSArgumentParser()
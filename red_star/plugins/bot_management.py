@@ -353,6 +353,9 @@ class BotManagement(BasePlugin):
             await respond(msg, f"**ANALYSIS: Config value {path} edited to** `{value}` **successfully.**")
 
         self.config_manager.save_config()
+        # The edit may have changed a command prefix or channel category
+        self.client.command_dispatcher.invalidate_prefixes()
+        self.client.channel_manager.rebuild_index()
 
     @Command("LastError",
              doc="Gets the last error to occur in the specified context.",
@@ -379,6 +382,56 @@ class BotManagement(BasePlugin):
         else:
             await respond(msg, f"**ANALYSIS: No error in context {args}.**")
 
+    @Command("RateLimits",
+             doc="Shows the command rate limiter's counters: how many commands were allowed and refused, and which "
+                 "were refused most.\nUse --reset to zero the counters.",
+             syntax="[-r/--reset]",
+             category="debug",
+             bot_maintainers_only=True,
+             dm_command=True)
+    async def _rate_limits(self, msg):
+        parser = RSArgumentParser()
+        parser.add_argument("command")
+        parser.add_argument("-r", "--reset", action="store_true")
+        args = parser.parse_args(msg.clean_content.split())
+
+        limiter = self.client.command_dispatcher.rate_limiter
+        limiter.sweep()
+        most_limited = "\n".join(f"{name}: {count}" for name, count in limiter.limited.most_common(10)) or "None"
+        await respond(msg, f"**ANALYSIS: Rate limiter counters:**```\n"
+                           f"Allowed: {limiter.counters['allowed']}\n"
+                           f"Refused: {limiter.counters['limited']}\n"
+                           f"Active buckets: {len(limiter.buckets)}\n\n"
+                           f"Most refused:\n{most_limited}\n```")
+        if args.reset:
+            limiter.counters.clear()
+            limiter.limited.clear()
+            await respond(msg, "**AFFIRMATIVE. Rate limiter counters reset.**")
+
+    @Command("CommandQueue",
+             doc="Shows the command scheduler's state: running and waiting commands, the deepest guild queues and "
+                 "how long commands waited to start.",
+             category="debug",
+             bot_maintainers_only=True,
+             dm_command=True)
+    async def _command_queue(self, msg):
+        scheduler = self.client.command_dispatcher.scheduler
+        stats = scheduler.stats
+        started = stats["completed"] + scheduler.running
+        mean_wait = stats["total_wait"] / started if started else 0
+        queued = scheduler.queued()
+        deepest = sorted(queued.items(), key=lambda x: x[1], reverse=True)[:10]
+        guilds = "\n".join(f"{self.client.get_guild(gid) or gid}: {depth}" for gid, depth in deepest) or "None"
+        await respond(msg, f"**ANALYSIS: Command scheduler:**```\n"
+                           f"Running: {scheduler.running}/{scheduler.concurrency}\n"
+                           f"Waiting: {len(scheduler.priority_queue)} priority, {sum(queued.values())} in guild "
+                           f"queues\n"
+                           f"Submitted: {stats['submitted']}, completed: {stats['completed']}, "
+                           f"dropped: {stats['dropped']}\n"
+                           f"Wait: {mean_wait * 1000:.0f}ms mean, {stats['max_wait'] * 1000:.0f}ms max\n"
+                           f"Deepest guild queue ever: {stats['max_depth']}\n\n"
+                           f"Deepest guild queues:\n{guilds}\n```")
+
     @Command("Execute", "Exec", "Eval",
              doc="Executes the given Python code. Be careful, you can really break things with this!\n"
                  "Provided variables are `ct` (shorthand for asyncio.create_task) and `self.res` "
@@ -2,16 +2,20 @@ import datetime
 import json
 import re
 from asyncio import sleep, create_task
+from collections import OrderedDict
+from copy import deepcopy
 from io import BytesIO
 from os import remove, path
 from red_star.plugin_manager import BasePlugin
 from discord import Embed, File, Forbidden, utils, Colour
 from red_star.command_dispatcher import Command
-from red_star.rs_errors import CommandSyntaxError, UserPermissionError, CustomCommandSyntaxError
+from red_star.rs_errors import CommandSyntaxError, UserPermissionError, CustomCommandSyntaxError, WorkerError, \
+    WorkerTimeoutError
 from red_star.rs_utils import respond, find_user, decode_json, group_items
-from .rs_lisp import lisp_eval, parse, reprint, standard_env, get_args
+from red_star.sqlite_storage import SqliteFileDict
+from red_star.worker_pool import WorkerPool, python_worker_env
+from .rs_lisp import lisp_compile, parse, reprint, standard_env, get_args, has_mutable_literals
 from dataclasses import dataclass, astuple
-from subprocess import Popen, PIPE, TimeoutExpired
 from sys import executable
 
 
@@ -37,72 +41,158 @@ class CustomCommands(BasePlugin):
         "rslisp_max_runtime": 5,
         "rslisp_minify": True,
         "cc_file_quota": 1024 * 1024,  # one megabyte
+        "cc_parse_cache_size": 256,
+        "rslisp_sandbox": True,
+        "rslisp_sandbox_workers": 2,
+        "rslisp_memory_limit": 256 * 1024 * 1024,  # 256 megabytes
+        "rpn_workers": 1,
     }
     channel_categories = {"no_cc"}
     log_events = {"cc_event"}
-    rpn_path = None
+    rpn_pool = None
+    lisp_pool = None
 
     async def activate(self):
-        self.ccs = self.config_manager.get_plugin_config_file("ccs.json", json_save_args={'ensure_ascii': False})
+        # gid -> that guild's custom commands, loaded from config/ccs/<gid>.json the first time they're needed
+        self.ccs = {}
+        (self.config_manager.config_path / "ccs").mkdir(parents=True, exist_ok=True)
+        self.bans = self.config_manager.get_plugin_config_file("cc_bans.json")
+        self._migrate_ccs()
         save_args = {'default': lambda o: astuple(o), 'ensure_ascii': False}
         load_args = {'object_pairs_hook': lambda obj: {k: CCFileMetadata(*v) for k, v in obj}}
         self.ccfdata = self.config_manager.get_plugin_config_file("cc_storage.json", json_save_args=save_args,
                                                                   json_load_args=load_args)
+        if isinstance(self.ccfdata, SqliteFileDict):
+            self.ccfdata.create_index("$[0]")  # the owner
         self.ccfolder = self.client.storage_dir / "ccfiles"
         self.ccfolder.mkdir(parents=True, exist_ok=True)
+        # (gid, cc name) -> (content, parsed AST, compiled program or None if it must be recompiled for every run)
+        self.ast_cache = OrderedDict()
+        self.client.command_dispatcher.register_prefix("custom_command", self._cc_prefix)
 
         for rpn_exec in (directory / "rpn_executor.py" for directory in self.client.plugin_directories):
             if path.isfile(rpn_exec):
-                self.rpn_path = rpn_exec
+                self.rpn_pool = WorkerPool([executable, str(rpn_exec), "--worker"],
+                                           size=self.plugin_config.get("rpn_workers", 1))
                 break
 
+        if self.plugin_config.get("rslisp_sandbox", True):
+            for worker in (directory / "_rs_lisp_worker.py" for directory in self.client.plugin_directories):
+                if path.isfile(worker):
+                    args = [executable, str(worker),
+                            "--memory-limit", str(self.plugin_config.get("rslisp_memory_limit", 0)),
+                            "--cache-size", str(self.plugin_config.get("cc_parse_cache_size", 256))]
+                    self.lisp_pool = WorkerPool(args, size=self.plugin_config.get("rslisp_sandbox_workers", 2),
+                                                env=python_worker_env())
+                    break
+            else:
+                self.logger.warning("RSLisp sandbox worker not found, custom commands will run inside the bot.")
+
+    async def deactivate(self):
+        self.client.command_dispatcher.deregister_prefix("custom_command")
+        if self.lisp_pool is not None:
+            await self.lisp_pool.close()
+            self.lisp_pool = None
+        if self.rpn_pool is not None:
+            await self.rpn_pool.close()
+            self.rpn_pool = None
+
+    def _migrate_ccs(self):
+        """
+        Splits the old ccs.json, which held every guild's custom commands and the bans, into one file per guild
+        and cc_bans.json. The old file is kept as ccs.json.migrated.
+        """
+        old_path = self.config_manager.config_path / "ccs.json"
+        if not old_path.exists():
+            return
+        with old_path.open(encoding="utf-8") as fd:
+            old_ccs = json.load(fd)
+        for gid, bans in old_ccs.pop("bans", {}).items():
+            self.bans.setdefault(gid, bans)
+        self.bans.save()
+        for gid, ccs in old_ccs.items():
+            guild_ccs = self._get_ccs(gid)
+            for name, cc_data in ccs.items():
+                guild_ccs.setdefault(name, cc_data)
+            guild_ccs.save()
+        old_path.rename(old_path.with_name("ccs.json.migrated"))
+        self.logger.info(f"Migrated custom commands of {len(old_ccs)} guilds from ccs.json.")
+
+    def _get_ccs(self, gid):
+        """
+        :param gid: The guild ID, as a string.
+        :return: The guild's custom commands, as a JsonFileDict of name -> command data. Writes to it only save that
+        guild's file.
+        """
         try:
-            self.bans = self.ccs["bans"]
+            return self.ccs[gid]
         except KeyError:
-            self.bans = self.ccs["bans"] = {}
+            ccs = self.ccs[gid] = self.config_manager.get_plugin_config_file(f"ccs/{gid}.json",
+                                                                             json_save_args={'ensure_ascii': False})
+            if isinstance(ccs, SqliteFileDict):
+                ccs.create_index("$.author")
+            return ccs
+
+    @staticmethod
+    def _ccs_by_author(ccs, author_id):
+        """
+        :param ccs: A guild's custom commands, as returned by _get_ccs.
+        :param author_id: The ID of the user.
+        :return: The names of the custom commands the user created. Looked up in the index if they're stored in
+        SQLite.
+        """
+        if isinstance(ccs, SqliteFileDict):
+            return ccs.find("$.author", author_id)
+        return [name for name, cc in ccs.items() if cc["author"] == author_id]
+
+    def _ccfiles_by_owner(self, owner_id):
+        """
+        :param owner_id: The ID of the user.
+        :return: The IDs of the CC data files the user uploaded. Looked up in the index if they're stored in SQLite.
+        """
+        if isinstance(self.ccfdata, SqliteFileDict):
+            return self.ccfdata.find("$[0]", owner_id)
+        return [fid for fid, data in self.ccfdata.items() if data.owner == owner_id]
 
     # Event hooks
 
     async def on_message(self, msg):
+        cmd = self.client.command_dispatcher.classify(msg).get("custom_command")
+        if cmd is None:
+            return
         gid = str(msg.guild.id)
         self._initialize(gid)
-        deco = self.plugin_config[gid]["cc_prefix"]
-        if msg.author != self.client.user:
-            cnt = msg.content
-            if cnt.startswith(deco):
-                if msg.author.id in self.bans[gid]["cc_use_ban"]:
-                    try:
-                        await msg.author.send(f"**WARNING: You are banned from usage of custom commands on this "
-                                              f"server.**")
-                    except Forbidden:
-                        pass
-                    return
-                elif self.channel_manager.channel_in_category(msg.guild, "no_cc", msg.channel):
+        if msg.author.id in self.bans[gid]["cc_use_ban"]:
+            try:
+                await msg.author.send(f"**WARNING: You are banned from usage of custom commands on this "
+                                      f"server.**")
+            except Forbidden:
+                pass
+            return
+        elif self.channel_manager.channel_in_category(msg.guild, "no_cc", msg.channel):
+            await self.plugin_manager.hook_event("on_log_event", msg.guild,
+                                                 f"**WARNING: Attempted CC use in restricted channel"
+                                                 f" {msg.channel.mention} by: {msg.author.display_name}**",
+                                                 log_type="cc_event")
+            return
+
+        ccs = self._get_ccs(gid)
+        if cmd in ccs:
+            if "restricted" not in ccs[cmd]:
+                ccs[cmd]["restricted"] = []
+            if ccs[cmd]["restricted"]:
+                for t_cat in ccs[cmd]["restricted"]:
+                    if self.channel_manager.channel_in_category(msg.guild, t_cat, msg.channel):
+                        break
+                else:
                     await self.plugin_manager.hook_event("on_log_event", msg.guild,
-                                                         f"**WARNING: Attempted CC use in restricted channel"
-                                                         f" {msg.channel.mention} by: {msg.author.display_name}**",
+                                                         f"**WARNING: Attempted CC use outside of it's "
+                                                         f"categories in {msg.channel.mention} by: "
+                                                         f"{msg.author}.**",
                                                          log_type="cc_event")
                     return
-
-                cmd = cnt[len(deco):].split()[0].lower()
-
-                if gid not in self.ccs:
-                    self.ccs[gid] = {}
-                if cmd in self.ccs[gid]:
-                    if "restricted" not in self.ccs[gid][cmd]:
-                        self.ccs[gid][cmd]["restricted"] = []
-                    if self.ccs[gid][cmd]["restricted"]:
-                        for t_cat in self.ccs[gid][cmd]["restricted"]:
-                            if self.channel_manager.channel_in_category(msg.guild, t_cat, msg.channel):
-                                break
-                        else:
-                            await self.plugin_manager.hook_event("on_log_event", msg.guild,
-                                                                 f"**WARNING: Attempted CC use outside of it's "
-                                                                 f"categories in {msg.channel.mention} by: "
-                                                                 f"{msg.author}.**",
-                                                                 log_type="cc_event")
-                            return
-                    await self.run_cc(cmd, msg)
+            await self.client.command_dispatcher.schedule(msg, lambda: self.run_cc(cmd, msg), f"cc/{cmd}",
+                                                          "custom_command")
 
     # Commands
 
@@ -111,7 +201,9 @@ class CustomCommands(BasePlugin):
              category="custom_commands",
              bot_maintainers_only=True)
     async def _reloadccs(self, msg):
-        self.ccs.reload()
+        for ccs in self.ccs.values():
+            ccs.reload()
+        self.ast_cache.clear()
         await respond(msg, "**AFFIRMATIVE. CCS reloaded.**")
 
     @Command("CreateCC", "NewCC",
@@ -140,12 +232,11 @@ class CustomCommands(BasePlugin):
                 content = args[1]
             except IndexError:
                 raise CommandSyntaxError("No content provided.")
-        if gid not in self.ccs:
-            self.ccs[gid] = {}
-        if name in self.ccs[gid]:
+        ccs = self._get_ccs(gid)
+        if name in ccs:
             await respond(msg, f"**WARNING: Custom command {name} already exists.**")
         else:
-            user_cc_count = len([True for cc in self.ccs[gid].values() if cc["author"] == msg.author.id])
+            user_cc_count = len(self._ccs_by_author(ccs, msg.author.id))
             cc_limit = self.plugin_config[gid].get("cc_limit", 100)
 
             if msg.author.id not in self.config_manager.config.get("bot_maintainers", []) and not \
@@ -170,8 +261,8 @@ class CustomCommands(BasePlugin):
                 "restricted": [],
                 "times_run": 0
             }
-            self.ccs[gid][name] = newcc
-            self.ccs.save()
+            ccs[name] = newcc
+            self.ast_cache.pop((gid, name), None)
             await respond(msg, f"**ANALYSIS: Custom command {name} created successfully.**")
 
     @Command("DumpCC",
@@ -187,10 +278,11 @@ class CustomCommands(BasePlugin):
             name = msg.content.split(" ", 1)[1].lower()
         except IndexError:
             raise CommandSyntaxError("No name provided.")
-        if name in self.ccs[gid]:
+        ccs = self._get_ccs(gid)
+        if name in ccs:
             async with msg.channel.typing():
                 await respond(msg, "**AFFIRMATIVE. Completed file upload.**",
-                              file=File(BytesIO(bytes(self.ccs[gid][name]["content"], encoding="utf-8")),
+                              file=File(BytesIO(bytes(ccs[name]["content"], encoding="utf-8")),
                                         filename=name + ".lisp"))
         else:
             raise CommandSyntaxError(f"No such custom command {name}.")
@@ -217,10 +309,9 @@ class CustomCommands(BasePlugin):
                 _, name, content = msg.clean_content.split(" ", 2)
             except ValueError:
                 raise CommandSyntaxError
-        if gid not in self.ccs:
-            self.ccs[gid] = {}
-        if name in self.ccs[gid]:
-            cc_data = self.ccs[gid][name]
+        ccs = self._get_ccs(gid)
+        if name in ccs:
+            cc_data = ccs[name]
             if cc_data["author"] == msg.author.id or msg.author.guild_permissions.manage_messages:
                 try:
                     parse(content)
@@ -229,8 +320,8 @@ class CustomCommands(BasePlugin):
                     return
                 cc_data["content"] = reprint(parse(content)) if self.plugin_config['rslisp_minify'] else content
                 cc_data["last_edited"] = datetime.datetime.now().strftime("%Y-%m-%d @ %H:%M:%S")
-                self.ccs[gid][name] = cc_data
-                self.ccs.save()
+                ccs[name] = cc_data
+                self.ast_cache.pop((gid, name), None)
                 await respond(msg, f"**ANALYSIS: Custom command {name} edited successfully.**")
             else:
                 raise UserPermissionError(f"You don't own custom command {name}.")
@@ -250,12 +341,11 @@ class CustomCommands(BasePlugin):
             name = msg.clean_content.split(None, 1)[1].lower()
         except IndexError:
             raise CommandSyntaxError("No name provided.")
-        if gid not in self.ccs:
-            self.ccs[gid] = {}
-        if name in self.ccs[gid]:
-            if self.ccs[gid][name]["author"] == msg.author.id or msg.author.guild_permissions.manage_messages:
-                del self.ccs[gid][name]
-                self.ccs.save()
+        ccs = self._get_ccs(gid)
+        if name in ccs:
+            if ccs[name]["author"] == msg.author.id or msg.author.guild_permissions.manage_messages:
+                del ccs[name]
+                self.ast_cache.pop((gid, name), None)
                 await respond(msg, f"**ANALYSIS: Custom command {name} deleted successfully.**")
             else:
                 raise UserPermissionError(f"You don't own custom command {name}.")
@@ -272,10 +362,9 @@ class CustomCommands(BasePlugin):
         except IndexError:
             raise CommandSyntaxError("No name provided.")
         gid = str(msg.guild.id)
-        if gid not in self.ccs:
-            self.ccs[gid] = {}
-        if name in self.ccs[gid]:
-            cc_data = self.ccs[gid][name]
+        ccs = self._get_ccs(gid)
+        if name in ccs:
+            cc_data = ccs[name]
             last_edited = f"Last Edited: {cc_data['last_edited']}\n" if cc_data["last_edited"] else ""
             cc_locked = "Yes" if cc_data["locked"] else "No"
             author = utils.get(msg.guild.members, id=cc_data["author"])
@@ -300,13 +389,12 @@ class CustomCommands(BasePlugin):
             raise CommandSyntaxError("No search provided.")
         user = find_user(msg.guild, search)
         gid = str(msg.guild.id)
-        if gid not in self.ccs:
-            self.ccs[gid] = {}
-        ccs_list = list(self.ccs[gid].keys())
+        ccs = self._get_ccs(gid)
+        ccs_list = list(ccs.keys())
         if search in ("*", "all"):
             matched_ccs = ccs_list
         elif user:
-            matched_ccs = filter(lambda x: self.ccs[gid][x]["author"] == user.id, ccs_list)
+            matched_ccs = self._ccs_by_author(ccs, user.id)
         else:
             matched_ccs = filter(lambda x: search in x.lower(), ccs_list)
         if matched_ccs:
@@ -328,11 +416,11 @@ class CustomCommands(BasePlugin):
         except IndexError:
             raise CommandSyntaxError("No name provided.")
         gid = str(msg.guild.id)
-        if gid not in self.ccs:
-            self.ccs[gid] = {}
-        if name in self.ccs[gid]:
-            self.ccs[gid][name]["locked"] = not self.ccs[gid][name]["locked"]
-            lock_status = "locked" if self.ccs[gid][name]["locked"] else "unlocked"
+        ccs = self._get_ccs(gid)
+        if name in ccs:
+            ccs[name]["locked"] = not ccs[name]["locked"]
+            ccs.save(name)
+            lock_status = "locked" if ccs[name]["locked"] else "unlocked"
             await respond(msg, f"**ANALYSIS: Custom command {name} has been {lock_status}.**")
         else:
             await respond(msg, f"**WARNING: No such custom command {name}.**")
@@ -345,21 +433,22 @@ class CustomCommands(BasePlugin):
              perms={"manage_messages"})
     async def _restrictcc(self, msg):
         gid = str(msg.guild.id)
-        if gid not in self.ccs:
-            self.ccs[gid] = {}
+        ccs = self._get_ccs(gid)
         try:
             _, name, category = msg.content.split(None, 2)
         except ValueError:
             raise CommandSyntaxError("Two arguments required.")
-        if name in self.ccs[gid]:
-            whitelist = self.ccs[gid][name].setdefault("restricted", [])
+        if name in ccs:
+            whitelist = ccs[name].setdefault("restricted", [])
 
             if self.channel_manager.get_category(msg.guild, category):
                 if category not in whitelist:
                     whitelist.append(category)
+                    ccs.save(name)
                     await respond(msg, f"**AFFIRMATIVE. Custom command {name} restricted to category {category}.**")
                 else:
                     whitelist.remove(category)
+                    ccs.save(name)
                     await respond(msg, f"**AFFIRMATIVE. Custom command {name} no longer restricted to category "
                                        f"{category}.**")
             else:
@@ -380,9 +469,11 @@ class CustomCommands(BasePlugin):
             raise CommandSyntaxError("Not a user, or user not found.")
         if user.id in self.bans[gid]["cc_use_ban"]:
             self.bans[gid]["cc_use_ban"].remove(user.id)
+            self.bans.save(gid)
             await respond(msg, f"**AFFIRMATIVE. User {user} was allowed the usage of custom commands.**")
         else:
             self.bans[gid]["cc_use_ban"].append(user.id)
+            self.bans.save(gid)
             await respond(msg, f"**AFFIRMATIVE. User {user} was banned from using custom commands.**")
 
     @Command("CCBan", "BanCC",
@@ -398,9 +489,11 @@ class CustomCommands(BasePlugin):
             raise CommandSyntaxError("Not a user, or user not found.")
         if user.id in self.bans[gid]["cc_create_ban"]:
             self.bans[gid]["cc_create_ban"].remove(user.id)
+            self.bans.save(gid)
             await respond(msg, f"**AFFIRMATIVE. User {user} was allowed creation of custom commands.**")
         else:
             self.bans[gid]["cc_create_ban"].append(user.id)
+            self.bans.save(gid)
             await respond(msg, f"**AFFIRMATIVE. User {user} was banned from creating custom commands.**")
 
     @Command("ListCCbans",
@@ -433,32 +526,30 @@ class CustomCommands(BasePlugin):
                  "Unary operators: sin, cos, tan, ln, pop (remove number from stack), int, dup (duplicate number in "
                  "stack), drop, modf, round, rndint.\n"
                  "Constants: e, pi, tau, m2f (one meter in feet), m2i (one meter in inches), rnd.",
-             run_anywhere=True)
+             run_anywhere=True,
+             rate_limit=(5, 10))
     async def _rpncmd(self, msg):
-        if self.rpn_path is None:
+        if self.rpn_pool is None:
             return
 
-        # sanitizing the input. Couldn't figure out a way to exploit Popen but *just in case*.
         num = re.compile(r"\d*\.\d+|\d+\.|0[xbo]\d+")
         ops = ("+", "-", "*", "/", "^", "%", "//", "log", "atan2", "swap", "min", "max", "sin", "cos", "tan", "ln",
                "pop", "int", "dup", "drop", "modf", "round", "rndint", "e", "pi", "tau", "m2f", "m2i", "rnd")
 
-        args = [executable, str(self.rpn_path)] + [a for a in msg.content.lower().split()
-                                                   if a in ops or a.isnumeric() or num.match(a)]
+        args = [a for a in msg.content.lower().split() if a in ops or a.isnumeric() or num.match(a)]
 
-        # a convoluted way to run the RPN in such a way that plugging 3 3 3 3 ^ ^ ^ or something like that into the bot
-        # doesn't make it lock up.
-        # TODO: figure out if we can make multiprocessing work after all, this is kind of a hack.
-        process = Popen(args, stdout=PIPE, stderr=PIPE, encoding="utf-8")
+        # evaluated in a worker process, so that plugging 3 3 3 3 ^ ^ ^ or something like that into the bot
+        # doesn't make it lock up. A worker that runs too long gets killed and replaced.
         try:
-            output, err = process.communicate(timeout=self.plugin_config.get('rslisp_max_runtime', 5))
-            process.wait()
-            if err:
-                raise CommandSyntaxError(output)
-            result = output.split()
-        except TimeoutExpired:
-            process.kill()
+            reply = await self.rpn_pool.request(args, timeout=self.plugin_config.get('rslisp_max_runtime', 5))
+        except WorkerTimeoutError:
             raise CommandSyntaxError("Command ran too long.")
+        except WorkerError as e:
+            self.logger.warning(f"RPN worker failed: {e}")
+            raise CommandSyntaxError("Command failed.")
+        if "error" in reply:
+            raise CommandSyntaxError(reply["error"])
+        result = reply["result"]
 
         await respond(msg, f"**Result : [ {' | '.join([str(x) for x in result])} ]**")
 
@@ -468,23 +559,24 @@ class CustomCommands(BasePlugin):
              doc="Evaluates the given string through RSLisp cc parser.",
              syntax="(custom command)",
              category="custom_commands",
-             perms={"manage_messages"})
+             perms={"manage_messages"},
+             rate_limit=(3, 15))
     async def _evalcc(self, msg):
         program = msg.content.split(None, 1)[1]
         try:
-            program = parse(program)
+            parse(program)
         except Exception as e:
             await respond(msg, f"**WARNING: Syntax error in custom command:** {e}")
+            return
         try:
-            env = self._env(msg)
-            result = lisp_eval(program, env)
+            output, result = await self._run_program(msg, program)
         except Exception as e:
             await respond(msg, f"**WARNING: Runtime error in custom command:** {e}")
         else:
-            if env['_rsoutput']:
-                await respond(msg, str(env['_rsoutput']))
+            if output:
+                await respond(msg, output)
             elif result:
-                await respond(msg, str(result))
+                await respond(msg, result)
 
     @Command("UploadCCData",
              doc="Uploads a cc-accessible data file in a json format.\n"
@@ -513,7 +605,7 @@ class CustomCommands(BasePlugin):
         if not fid.isidentifier():
             raise CommandSyntaxError("Illegal characters in file ID.")
 
-        total_size = sum([x.size for x in self.ccfdata.values() if x.owner == msg.author.id])
+        total_size = sum(self.ccfdata[x].size for x in self._ccfiles_by_owner(msg.author.id))
 
         if fid in self.ccfdata:
             if self.ccfdata[fid].owner != msg.author.id:
@@ -598,6 +690,7 @@ class CustomCommands(BasePlugin):
                 if self.ccfdata[fid].owner != msg.author.id and not self.config_manager.is_maintainer(msg.author):
                     raise UserPermissionError
                 self.ccfdata[fid].desc = desc.replace('\r', '')
+                self.ccfdata.save(fid)
                 await respond(msg, "**AFFIRMATIVE. Description updated.**")
             else:
                 raise CommandSyntaxError(f"No file {fid} found.")
@@ -637,53 +730,143 @@ class CustomCommands(BasePlugin):
                 "cc_use_ban": []
             }
 
+    def _cc_prefix(self, guild):
+        gid = str(guild.id)
+        self._initialize(gid)
+        return self.plugin_config[gid]["cc_prefix"]
+
     async def run_cc(self, cmd, msg):
         gid = str(msg.guild.id)
-        if self.ccs[gid][cmd]["locked"] and not msg.author.guild_permissions.manage_messages:
+        ccs = self._get_ccs(gid)
+        # The command may have been deleted or renamed while it was waiting to run
+        cc = ccs.get(cmd)
+        if cc is None:
+            return
+        if cc["locked"] and not msg.author.guild_permissions.manage_messages:
             await respond(msg, f"**WARNING: Custom command {cmd} is locked.**")
         else:
-            env = self._env(msg)
-
-            cc_data = self.ccs[gid][cmd]["content"]
+            cc_data = cc["content"]
             try:
-                res = lisp_eval(parse(cc_data), env)
+                output, result = await self._run_program(msg, cc_data, cmd)
             except CustomCommandSyntaxError as e:
                 err = e if e else "Syntax error."
                 await respond(msg, f"**WARNING: Author made syntax error: {err}**")
             except CommandSyntaxError as e:
                 err = e if e else "Syntax error."
                 await respond(msg, f"**WARNING: {err}**")
+            except WorkerError as e:
+                await respond(msg, f"**WARNING: An error occurred while running the custom command: {e}**")
             except Exception as e:
                 err = e if e else "Syntax error."
                 self.logger.exception("Exception occurred in custom command: ", exc_info=True)
                 await respond(msg, f"**WARNING: An error occurred while running the custom command: {err}**")
             else:
-                if env['_rsoutput']:
-                    await respond(msg, env['_rsoutput'])
-                elif res:
-                    await respond(msg, str(res))
-                self.ccs[gid][cmd]["times_run"] += 1
-                self.ccs.save()
+                if output:
+                    await respond(msg, output)
+                elif result:
+                    await respond(msg, result)
+                if ccs.get(cmd) is cc:
+                    cc["times_run"] += 1
+                    ccs.save(cmd)
+
+    async def _run_program(self, msg, content, cmd=None):
+        """
+        Runs an RSLisp program, in a sandbox worker process if they are enabled.
+        :param msg: The message that called the program.
+        :param content: The program's source.
+        :param cmd: The name of the custom command being run, if it is one. Enables caching of the compiled program.
+        :return: The program's printed output and its result, as strings. Either may be empty.
+        :raises CommandSyntaxError: If the program failed, with CustomCommandSyntaxError for the author's mistakes.
+        :raises WorkerError: If the program raised an unexpected exception inside the sandbox.
+        """
+        if self.lisp_pool is None:
+            env = self._env(msg)
+            if cmd is not None:
+                program = self._get_program(str(msg.guild.id), cmd, content)
+            else:
+                program = lisp_compile(parse(content))
+            result = program(env)
+            return env['_rsoutput'], str(result) if result else ""
+
+        max_runtime = self.plugin_config.get('rslisp_max_runtime', 0)
+        request = {
+            "program": content,
+            "env": self._env_data(msg),
+            "roles": [role.name for role in msg.author.roles],
+            "ccfolder": str(self.ccfolder),
+            "max_runtime": max_runtime
+        }
+        try:
+            # the worker gets killed by its CPU limit shortly after max_runtime, the timeout catches sleeping ones
+            reply = await self.lisp_pool.request(request, timeout=max_runtime + 2 if max_runtime else None)
+        except WorkerTimeoutError:
+            raise CustomCommandSyntaxError("The command ran too long.")
+        except WorkerError as e:
+            self.logger.warning(f"RSLisp sandbox worker failed: {e}")
+            raise CustomCommandSyntaxError("The command ran too long or used too much memory.")
+
+        for effect, *args in reply["effects"]:
+            if effect == "embed":
+                self._embed(msg, None, dict(args[0]))
+            elif effect == "delcall":
+                self._delcall(msg)
+
+        error = reply["error"]
+        if error is None:
+            return reply["output"], reply["result"]
+        elif error["kind"] == "cc_syntax":
+            raise CustomCommandSyntaxError(error["message"])
+        elif error["kind"] == "syntax":
+            raise CommandSyntaxError(error["message"])
+        else:
+            self.logger.error(f"Exception occurred in custom command:\n{error.get('traceback', '')}")
+            raise WorkerError(error["message"])
+
+    def _get_program(self, gid, name, content):
+        """
+        Fetches the compiled program of a custom command from the LRU cache, parsing and compiling it if it isn't
+        cached or its content changed since. Programs containing quoted lists are compiled from a fresh copy of the
+        AST on every run, since the program could modify them.
+        """
+        key = (gid, name)
+        try:
+            cached_content, ast, program = self.ast_cache[key]
+            if cached_content != content:
+                raise KeyError
+            self.ast_cache.move_to_end(key)
+        except KeyError:
+            ast = parse(content)
+            program = lisp_compile(ast) if not has_mutable_literals(ast) else None
+            self.ast_cache[key] = (content, ast, program)
+            self.ast_cache.move_to_end(key)
+            while len(self.ast_cache) > self.plugin_config.get("cc_parse_cache_size", 256):
+                self.ast_cache.popitem(last=False)
+        return program if program is not None else lisp_compile(deepcopy(ast))
 
     #  tag functions that *require* the discord machinery
 
-    def _env(self, msg):
+    def _env_data(self, msg):
         gid = str(msg.guild.id)
-        cmd = msg.content[len(self.plugin_config[gid]["cc_prefix"]):].split()[0].lower()
-        env = standard_env(max_runtime=self.plugin_config.get('rslisp_max_runtime', 0))
-
-        env['username'] = msg.author.name
-        env['usernick'] = msg.author.display_name
-        env['usermention'] = msg.author.mention
+        cmd = self.client.command_dispatcher.classify(msg).get("custom_command")
+        data = {
+            'username': msg.author.name,
+            'usernick': msg.author.display_name,
+            'usermention': msg.author.mention
+        }
         try:
-            author = utils.get(msg.guild.members, id=self.ccs[gid][cmd]['author'])
-            env['authorname'] = author.name
-            env['authornick'] = author.display_name
+            author = utils.get(msg.guild.members, id=self._get_ccs(gid)[cmd]['author'])
+            data['authorname'] = author.name
+            data['authornick'] = author.display_name
         except (AttributeError, KeyError):
-            env['authorname'] = env['authornick'] = '<Unknown user>'
+            data['authorname'] = data['authornick'] = '<Unknown user>'
         args = msg.clean_content.split(" ", 1)
-        env['argstring'] = args[1] if len(args) > 1 else ''
-        env['args'] = args[1].split(" ") if len(args) > 1 else []
+        data['argstring'] = args[1] if len(args) > 1 else ''
+        data['args'] = args[1].split(" ") if len(args) > 1 else []
+        return data
+
+    def _env(self, msg):
+        env = standard_env(max_runtime=self.plugin_config.get('rslisp_max_runtime', 0))
+        env.update(self._env_data(msg))
 
         env['hasrole'] = lambda *x: self._hasrole(msg, *x)
         env['delcall'] = lambda: self._delcall(msg)
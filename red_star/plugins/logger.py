@@ -1,5 +1,7 @@
+from asyncio import create_task, wait_for, Event, Semaphore, TimeoutError
+from collections import deque
 from datetime import datetime, timedelta
-from discord import AuditLogAction, Forbidden
+from discord import AuditLogAction, Forbidden, HTTPException
 from red_star.plugin_manager import BasePlugin
 from red_star.rs_errors import ChannelNotFoundError, CommandSyntaxError
 from red_star.rs_utils import split_message, respond, close_markdown
@@ -16,14 +18,25 @@ class DiscordLogger(BasePlugin):
         "default": {
             "log_event_blacklist": [
             ]
-        }
+        },
+        "log_queue_max_items": 500,
+        "log_batch_size": 25,
+        "log_flush_interval": 5,
+        "log_send_concurrency": 2
     }
     channel_types = {"logs"}
     log_events = {"message_delete", "message_edit", "member_update", "pin_update", "member_ban", "member_unban",
                   "member_join", "member_leave", "role_update"}
 
     async def activate(self):
-        self.log_items = {}
+        self.log_queues = {}
+        # Shared by every guild, so that a burst of logs in one can't hog the connection
+        self.send_budget = Semaphore(self.plugin_config.get("log_send_concurrency", 2))
+
+    async def deactivate(self):
+        for queue in self.log_queues.values():
+            if queue.worker:
+                queue.worker.cancel()
 
     async def on_all_plugins_loaded(self):
         for plg in self.plugins.values():
@@ -35,20 +48,11 @@ class DiscordLogger(BasePlugin):
                 self.logger.debug(f"Registered log events {', '.join(plg_log_events)} from {plg.name}.")
 
     async def on_global_tick(self, *_):
+        # Retries guilds whose log channel couldn't be reached, if nothing was logged there since
         for guild in self.client.guilds:
-            gid = str(guild.id)
-            try:
-                log_channel = self.channel_manager.get_channel(guild, "logs")
-            except ChannelNotFoundError:
-                continue
-            if gid in self.log_items and self.log_items[gid]:
-                logs = "\n".join(self.log_items[gid])
-                if not logs:
-                    continue
-                for msg in split_message(logs, splitter="\n"):
-                    if msg and not msg.isspace():
-                        await log_channel.send(msg)
-                self.log_items[gid].clear()
+            queue = self.log_queues.get(str(guild.id))
+            if queue and queue.items and not queue.worker:
+                queue.worker = create_task(self._flush_worker(guild, queue))
 
     async def on_message_delete(self, msg):
         blacklist = self.plugin_config.setdefault(str(msg.guild.id),
@@ -230,8 +234,63 @@ class DiscordLogger(BasePlugin):
             self.logger.info(string)
 
     def emit_log(self, log_str, guild):
-        guild_log_queue = self.log_items.setdefault(str(guild.id), [])
-        guild_log_queue.append(log_str)
+        try:
+            queue = self.log_queues[str(guild.id)]
+        except KeyError:
+            queue = self.log_queues[str(guild.id)] = LogQueue(self.plugin_config.get("log_queue_max_items", 500))
+        queue.append(log_str)
+        if len(queue.items) >= self.plugin_config.get("log_batch_size", 25):
+            queue.full.set()
+        if not queue.worker:
+            queue.worker = create_task(self._flush_worker(guild, queue))
+
+    async def _flush_worker(self, guild, queue):
+        """
+        Sends a guild's queued logs to its log channel, in batches: once enough logs have piled up, or once the
+        oldest of them has waited for the flush interval. Exits when the queue is empty, or when the log channel
+        can't be reached, leaving the logs queued.
+        """
+        try:
+            while queue.items:
+                try:
+                    await wait_for(queue.full.wait(), self.plugin_config.get("log_flush_interval", 5))
+                except TimeoutError:
+                    pass
+                queue.full.clear()
+                if not await self._flush(guild, queue):
+                    break
+        finally:
+            queue.worker = None
+
+    async def _flush(self, guild, queue):
+        """
+        :return: False if the log channel couldn't be reached, True otherwise.
+        """
+        try:
+            log_channel = self.channel_manager.get_channel(guild, "logs")
+        except ChannelNotFoundError:
+            return False
+        if queue.dropped:
+            self.logger.warning(f"Dropped {queue.dropped} log entries for {guild}, as its log queue was full.")
+            queue.items.appendleft(f"**WARNING: {queue.dropped} log entries were dropped, as the log queue was "
+                                   f"full.**")
+            queue.dropped = 0
+        logs = "\n".join(queue.items)
+        queue.items.clear()
+        chunks = deque(msg for msg in split_message(logs, splitter="\n") if msg and not msg.isspace())
+        while chunks:
+            try:
+                async with self.send_budget:
+                    await log_channel.send(chunks[0])
+            except Forbidden:
+                # Put back what wasn't sent, ahead of anything logged in the meantime
+                queue.items.extendleft(reversed(chunks))
+                queue.trim()
+                return False
+            except HTTPException as e:
+                self.logger.warning(f"Failed to send log message to {log_channel} in {guild}: {e}")
+            chunks.popleft()
+        return True
 
     @Command("LogEvent",
              doc="Adds or removes the events to be logged.",
@@ -270,3 +329,26 @@ class DiscordLogger(BasePlugin):
                 await respond(msg, f"**ANALYSIS: Event type {event_type} is already logged.**")
         else:
             raise CommandSyntaxError(f"Action {action} is not a valid action.")
+
+
+class LogQueue:
+    """
+    A guild's logs waiting to be sent. Holds at most max_items entries; when it's full, the oldest are dropped and
+    counted, so that a log channel that can't be reached doesn't make the queue grow without bound.
+    """
+
+    def __init__(self, max_items):
+        self.items = deque()
+        self.max_items = max_items
+        self.dropped = 0
+        self.full = Event()
+        self.worker = None
+
+    def append(self, log_str):
+        self.items.append(log_str)
+        self.trim()
+
+    def trim(self):
+        while len(self.items) > self.max_items:
+            self.items.popleft()
+            self.dropped += 1
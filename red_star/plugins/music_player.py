@@ -2,13 +2,19 @@ import enum
 import logging
 import re
 import shlex
-from asyncio import create_task, get_running_loop, run_coroutine_threadsafe, TimeoutError
+import threading
+from asyncio import create_task, get_running_loop, run_coroutine_threadsafe, shield, TimeoutError
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from discord import FFmpegPCMAudio, PCMVolumeTransformer, Embed, ClientException
 from math import floor, ceil
 from functools import partial
+from itertools import islice
 from os import remove as remove_file
-from random import randint
-from time import monotonic as time
+from pathlib import Path
+from random import randint, shuffle
+from time import monotonic as time, time as timestamp
+from urllib.parse import urlsplit, urlunsplit
 from youtube_dl import YoutubeDL
 from youtube_dl.utils import YoutubeDLError
 from red_star.command_dispatcher import Command
@@ -25,7 +31,17 @@ class MusicPlayer(BasePlugin):
     default_config = {
         "save_audio": True,
         "video_cache_clear_age": 259200,
+        "audio_cache_max_bytes": 2 * 1024 ** 3,  # two gigabytes
+        "audio_cache_max_files": 1000,
+        "metadata_cache_ttl": 86400,
+        "metadata_cache_max_entries": 5000,
         "default_volume": 15,
+        "extractor_threads": 3,
+        "playlist_lookahead": 4,
+        "prefetch_tracks": 2,
+        "stream_url_max_age": 1800,
+        "position_save_interval": 60,
+        "state_save_delay": 5,
         "youtube_dl_config": {
             "quiet": True,
             "restrictfilenames": True,
@@ -50,6 +66,22 @@ class MusicPlayer(BasePlugin):
 
     async def activate(self):
         self.storage = self.config_manager.get_plugin_config_file("music_player.json")
+        # guild ID -> snapshot of that guild's player; kept apart from the caches, so that saving one is cheap
+        self.player_states = self.config_manager.get_plugin_config_file(
+                "music_players.json", write_delay=self.plugin_config.get("state_save_delay", 5))
+        if "players" in self.storage:  # Port from the old music_player.json storage
+            for gid, state in self.storage.pop("players").items():
+                self.player_states.setdefault(gid, state)
+            self.player_states.save()
+            self.storage.save()
+        # cache key -> extracted video info; one row per key, so that adding an entry doesn't rewrite the others
+        self.metadata_storage = self.config_manager.get_plugin_config_file("music_metadata.json", backend="sqlite")
+        if "metadata_cache" in self.storage:  # Port from the old music_player.json storage
+            with self.metadata_storage.transaction():
+                for key, entry in self.storage.pop("metadata_cache").items():
+                    self.metadata_storage.setdefault(key, entry)
+                self.metadata_storage.save()
+            self.storage.save()
 
         self.players = {}
 
@@ -58,10 +90,41 @@ class MusicPlayer(BasePlugin):
         self.ydl_options["extract_flat"] = "in_playlist"
         self.ydl_options["outtmpl"] = str(self.client.storage_dir / "music_cache" /
                                           self.ydl_options.get("outtmpl", "%(id)s-%(extractor)s.%(ext)s"))
+        self.extractor = ExtractorService(self.ydl_options, self.plugin_config.get("extractor_threads", 3))
+        self.audio_cache = AudioCache(self.storage, self.plugin_config)
+        self.metadata_cache = MetadataCache(self.metadata_storage, self.plugin_config)
+        create_task(self._restore_players())
 
     async def deactivate(self):
         for player in self.players.values():
+            player.save_state()
+            # Closed players stop saving their state, so that disconnecting doesn't overwrite the snapshot
+            player.closed = True
+            player.stop()
             await player.voice_client.disconnect()
+        self.extractor.close()
+
+    async def _restore_players(self):
+        """
+        Rejoins the voice channels the bot was playing in before the plugin was last deactivated, and resumes playback
+        where it left off. Queued videos come back with their saved info and files, so youtube-dl is only needed for
+        files that were evicted from the cache since, or stream URLs that expired.
+        """
+        saved_players = self.player_states
+        for gid, state in tuple(saved_players.items()):
+            voice_channel = self.client.get_channel(state["voice_channel"])
+            text_channel = self.client.get_channel(state["text_channel"])
+            if not voice_channel or not text_channel or int(gid) in self.players:
+                del saved_players[gid]
+                continue
+            try:
+                player = await self.create_player(voice_channel, text_channel)
+            except (TimeoutError, ClientException) as e:
+                self.logger.warning(f"Failed to rejoin voice channel {voice_channel.name} in guild {gid}: {e}")
+                del saved_players[gid]
+                continue
+            player.restore_state(state)
+            self.logger.info(f"Resumed music playback in voice channel {voice_channel.name} in guild {gid}.")
 
     # Command functions
 
@@ -103,8 +166,8 @@ class MusicPlayer(BasePlugin):
                 and not self.config_manager.is_maintainer(msg.author):
             raise UserPermissionError
         player.queue.clear()
-        player.already_played.clear()
         player.stop()
+        player.clear_state()
         await player.voice_client.disconnect()
         del self.players[msg.guild.id]
         await respond(msg, "**ANALYSIS: Disconnected from voice channel.**")
@@ -117,7 +180,8 @@ class MusicPlayer(BasePlugin):
                  "third through fifth videos, {-2} selects all videos up to the second, {6-} selects the sixth video "
                  "and all after it. Multiple slices can be used on one playlist by separating them with ,.",
              syntax="(url) [url_2] [url_3]...",
-             category="music_player")
+             category="music_player",
+             rate_limit=(3, 15))
     async def _play_song(self, msg):
         player = self.get_guild_player(msg)
         if not player:
@@ -167,7 +231,8 @@ class MusicPlayer(BasePlugin):
         if vid.get("tags") is not None:
             embed.set_footer(text=f"Tags: {', '.join(vid['tags'])}")
         play_time, duration, _ = player.progress
-        rating_field = f"Views: {vid.get('view_count', 'Unknown'):,}."
+        view_count = vid.get("view_count")
+        rating_field = f"Views: {view_count:,}." if isinstance(view_count, int) else "Views: Unknown."
         if vid.get("like_count") is not None:
             rating_field += f" {vid['like_count']:,}👍"
         if vid.get("dislike_count") is not None:
@@ -202,17 +267,10 @@ class MusicPlayer(BasePlugin):
             raise CommandSyntaxError("Provided integer must be positive")
         index -= 1
         try:
-            del_song = player.queue.pop(index)
-            if index in player.already_played:
-                player.already_played.remove(index)
-            new_already_played = set()
-            for i in player.already_played:
-                if i > index:
-                    i -= 1
-                new_already_played.add(i)
-            player.already_played = new_already_played
+            del_song = player.queue.pop_at(index)
         except IndexError:
             raise CommandSyntaxError("Integer provided is not a valid index")
+        player.save_state()
         await respond(msg, f"**AFFIRMATIVE. Deleted song at position {index + 1} ({del_song['title']}).**")
         if get_guild_config(self, str(msg.guild.id), "print_queue_on_edit") and player.queue:
             for split_msg in split_message(f"**ANALYSIS: Current queue:**{player.print_queue()}"):
@@ -275,7 +333,7 @@ class MusicPlayer(BasePlugin):
             player.song_mode = SongMode.SHUFFLE
         elif arg in ("sr", "shuffle_repeat", "random_repeat"):
             player.song_mode = SongMode.SHUFFLE_REPEAT
-            player.already_played.clear()
+            player.queue.reset_shuffle()
         else:
             raise CommandSyntaxError(f"Argument {arg} is not a valid mode")
         await respond(msg, f"**AFFIRMATIVE. Song mode changed to {player.song_mode}.**")
@@ -311,7 +369,6 @@ class MusicPlayer(BasePlugin):
                     player.song_mode = SongMode.NORMAL
                     await respond(msg, f"**AFFIRMATIVE. Shuffle disabled.**")
                 elif player.song_mode is SongMode.SHUFFLE_REPEAT:
-                    player.already_played.clear()
                     player.song_mode = SongMode.REPEAT_QUEUE
                     await respond(msg, f"**AFFIRMATIVE. Shuffle disabled. Queue repeat still enabled.**")
             else:
@@ -362,7 +419,7 @@ class MusicPlayer(BasePlugin):
             if player.song_mode in (SongMode.NORMAL, SongMode.SHUFFLE):
                 await respond("**ANALYSIS: Repeat mode is disabled.**")
             elif player.song_mode is SongMode.SHUFFLE_REPEAT:
-                player.already_played.clear()
+                player.queue.reset_shuffle()
                 player.song_mode = SongMode.SHUFFLE
                 await respond(msg, "**AFFIRMATIVE. Repeat mode disabled. Shuffle still enabled.**")
             else:
@@ -409,7 +466,6 @@ class MusicPlayer(BasePlugin):
             await respond(msg, "**ANALYSIS: No music currently playing.")
             return
         player.queue.clear()
-        player.already_played.clear()
         player.stop()
         await respond(msg, "**ANALYSIS: The music has been stopped and the queue has been cleared.**")
 
@@ -482,19 +538,19 @@ class MusicPlayer(BasePlugin):
     # Utility functions
 
     async def on_global_tick(self, _, dt):
-        # Cache reaper
-        save_required = False
-        for file, dl_time in self.storage["downloaded_songs"].copy().items():
-            if time() - dl_time > self.plugin_config["video_cache_clear_age"]:
-                try:
-                    remove_file(file)
-                    del self.storage["downloaded_songs"][file]
-                    self.logger.debug(f"Deleted old video cache file {file}.")
-                    save_required = True
-                except OSError:
-                    continue
-        if save_required:
+        # Cache reaper. Files still queued or playing are kept, even if they are due for eviction.
+        in_use = {vid.get("filename") for player in self.players.values()
+                  for vid in (*player.queue, player.current_song)}
+        evicted = self.audio_cache.evict(in_use)
+        if evicted:
+            self.logger.debug(f"Deleted {evicted} files from the audio cache.")
             self.storage.save()
+        self.metadata_cache.expire()
+        # Keeping the saved playback position roughly current is enough to resume from
+        interval = self.plugin_config.get("position_save_interval", 60)
+        for player in self.players.values():
+            if player.current_song and time() - player.position_saved_at >= interval:
+                player.save_position()
         # Auto-disconnect
         for player in tuple(self.players.values()):
             await player.idle_check(dt)
@@ -526,11 +582,10 @@ class GuildPlayer:
         self.text_channel = channel
         self.voice_client = voice_client
         self.logger = logging.getLogger(f"red_star.plugin.music_player.player_{self.voice_client.guild.id}")
-        self.queue = []
-        self.already_played = set()
+        self.queue = SongQueue()
         self.is_playing = False
         self.current_song = {}
-        self.song_mode = SongMode.NORMAL
+        self._song_mode = SongMode.NORMAL
         self.prev_volume = None
         self._volume = self.parent.plugin_config["default_volume"] / 100
         self._song_start_time = None
@@ -538,57 +593,66 @@ class GuildPlayer:
         self._skip_votes = set()
         self.gid = str(voice_client.guild.id)
         self._alone_time = 0
+        self._preparing = {}
+        self._prefetch_task = None
+        self._resume = None
+        self.closed = False
+        self.position_saved_at = 0
+        # The version of the queue last written to the snapshot, so that it's only copied again once it changes
+        self._saved_queue_version = None
 
     async def prepare_playlist(self, urls):
         with self.text_channel.typing():
             # Fetch video info
-            with YoutubeDL(self.parent.ydl_options) as ydl:
-                # Create a list of videos to be queued
-                to_queue = []
-                for url in urls:
-                    try:
-                        pl_slice = re.match(r"([^{`]+)`*(?:{([^}]*)})?", url)
-                        vid_info = await get_running_loop().run_in_executor(None, partial(ydl.extract_info,
-                                                                                          pl_slice[1], download=False))
-                    except YoutubeDLError as e:
-                        await self.text_channel.send(f"**WARNING. An error occurred while downloading video <{url}>. "
-                                                     f"It will not be queued.\nError details:** `{e}`")
-                        continue
-                    # If it's a playlist, we need to flatten it into our to_queue list, and deal with the slicing
-                    if vid_info.get("_type") == "playlist":
-                        # Slice handling
-                        if pl_slice[2]:
-                            pl_slices = pl_slice[2].split(",")
-                            for s in pl_slices:
-                                # Ranges handling
-                                if "-" in s:
-                                    s_start, s_end = s.split("-", 1)
-                                    try:
-                                        s_start = int(s_start) - 1
-                                    except ValueError:
-                                        s_start = 0
-                                    try:
-                                        s_end = int(s_end)
-                                        if s_end > len(vid_info["entries"]):
-                                            raise ValueError
-                                    except ValueError:
-                                        s_end = len(vid_info["entries"])
-                                    if s_end < s_start:
-                                        continue
-                                    to_queue.extend(vid_info["entries"][s_start:s_end])
-                                # Single values
-                                else:
-                                    try:
-                                        s = int(s) - 1
-                                        to_queue.append(vid_info["entries"][s])
-                                    except (ValueError, IndexError):
-                                        continue
-                        # No slice
-                        else:
-                            to_queue.extend(vid_info["entries"])
-                    # If it's just a video, throw it in
+            # Create a list of videos to be queued
+            to_queue = []
+            for url in urls:
+                pl_slice = re.match(r"([^{`]+)`*(?:{([^}]*)})?", url)
+                cached = self._cached_video(url=pl_slice[1])
+                if cached:
+                    to_queue.append(cached)
+                    continue
+                try:
+                    vid_info = await self._extract_info(pl_slice[1])
+                except YoutubeDLError as e:
+                    await self.text_channel.send(f"**WARNING. An error occurred while downloading video <{url}>. "
+                                                 f"It will not be queued.\nError details:** `{e}`")
+                    continue
+                # If it's a playlist, we need to flatten it into our to_queue list, and deal with the slicing
+                if vid_info.get("_type") == "playlist":
+                    # Slice handling
+                    if pl_slice[2]:
+                        pl_slices = pl_slice[2].split(",")
+                        for s in pl_slices:
+                            # Ranges handling
+                            if "-" in s:
+                                s_start, s_end = s.split("-", 1)
+                                try:
+                                    s_start = int(s_start) - 1
+                                except ValueError:
+                                    s_start = 0
+                                try:
+                                    s_end = int(s_end)
+                                    if s_end > len(vid_info["entries"]):
+                                        raise ValueError
+                                except ValueError:
+                                    s_end = len(vid_info["entries"])
+                                if s_end < s_start:
+                                    continue
+                                to_queue.extend(vid_info["entries"][s_start:s_end])
+                            # Single values
+                            else:
+                                try:
+                                    s = int(s) - 1
+                                    to_queue.append(vid_info["entries"][s])
+                                except (ValueError, IndexError):
+                                    continue
+                    # No slice
                     else:
-                        to_queue.append(vid_info)
+                        to_queue.extend(vid_info["entries"])
+                # If it's just a video, throw it in
+                else:
+                    to_queue.append(vid_info)
             # Queuing is handle by _enqueue_playlist function. Don't bother it if we got nothing.
             if len(to_queue) > 0:
                 create_task(self._enqueue_playlist(to_queue))
@@ -602,101 +666,185 @@ class GuildPlayer:
             await self.text_channel.send(f"**ANALYSIS: Attempting to queue {len(entries)} videos. Your playback will "
                                          f"begin shortly.{time_until_song}**")
         orig_len = len(self.queue)
+        # Entries are resolved a few at a time in parallel, but queued strictly in playlist order
+        lookahead = max(1, self.parent.plugin_config.get("playlist_lookahead", 4))
+        entries = iter(entries)
+        pending = deque()
+
+        def fill_pending():
+            for entry in entries:
+                pending.append(create_task(self._resolve_entry(entry)))
+                if len(pending) >= lookahead:
+                    break
+
         with self.text_channel.typing():
-            with YoutubeDL(self.parent.ydl_options) as ydl:
-                for vid in entries:
-                    # We only want to extract info if we don't already have it. Things get a little funky otherwise.
-                    if vid.get("_type") in ("url", "url_transparent"):
-                        try:
-                            vid = await get_running_loop().run_in_executor(None, partial(ydl.extract_info, vid["url"],
-                                                                                         download=False))
-                        # Skip broken videos while trying the rest
-                        except YoutubeDLError as e:
-                            await self.text_channel.send(f"**WARNING. An error occurred while downloading video "
-                                                         f"<{vid['url']}>. It will not be queued.\nError details:** "
-                                                         f"`{e}`")
-                            continue
+            fill_pending()
+            try:
+                while pending:
+                    vid, warning = await pending.popleft()
+                    fill_pending()
                     # Abort once the queue is full
                     if len(self.queue) >= get_guild_config(self.parent, self.gid, "max_queue_length"):
                         await self.text_channel.send(f"**WARNING: The queue is full. No more videos will be added.**")
                         break
-                    # Skip over videos that are too long
-                    elif vid.get("duration", 0) > get_guild_config(self.parent, self.gid, "max_video_length"):
-                        max_len = pretty_duration(get_guild_config(self.parent, self.gid, "max_video_length"))
-                        await self.text_channel.send(f"**WARNING: Video {vid['title']} exceeds the maximum video"
-                                                     f" length ({max_len}). It will not be added.**")
-                        continue
-                    try:
-                        await self._process_video(vid)
-                    except TypeError:
+                    if warning:
+                        await self.text_channel.send(warning)
+                    if not vid:
                         continue
+                    self.queue.append(vid)
+                    if len(self.queue) <= self.parent.plugin_config.get("prefetch_tracks", 2):
+                        self._start_prefetch()
                     if not self.is_playing:
+                        # Set right away, so that the next entry doesn't start a second _play before this one runs
+                        self.is_playing = True
                         try:
                             create_task(self._play())
                         except ClientException:
                             pass
+            finally:
+                for task in pending:
+                    task.cancel()
+        self.save_state()
         await self.text_channel.send(f"**ANALYSIS: Queued {len(self.queue) - orig_len} videos.**")
         if get_guild_config(self.parent, self.gid, "print_queue_on_edit") and self.queue:
             final_msg = f"**ANALYSIS: Current queue:**{self.print_queue()}"
             for msg in split_message(final_msg):
                 await self.text_channel.send(msg)
 
-    async def _process_video(self, vid):
+    async def _resolve_entry(self, vid):
+        """
+        Extracts a playlist entry. Downloading is left to _prepare_video, once the video is about to play.
+        :param vid: The entry, either full video info or a url-type reference to it.
+        :return: A tuple of the video ready to be queued or None, and a warning to show in its place or None.
+        """
+        # We only want to extract info if we don't already have it. Things get a little funky otherwise.
+        if vid.get("_type") in ("url", "url_transparent"):
+            vid = self._cached_video(entry=vid) or vid
+        if vid.get("_type") in ("url", "url_transparent"):
+            try:
+                vid = await self._extract_info(vid["url"])
+            # Skip broken videos while trying the rest
+            except YoutubeDLError as e:
+                return None, f"**WARNING. An error occurred while downloading video <{vid['url']}>. It will not be " \
+                             f"queued.\nError details:** `{e}`"
         if not vid:
-            raise TypeError
-        if self.parent.plugin_config["save_audio"] and not vid.get("is_live", False):
-            with YoutubeDL(self.parent.ydl_options) as ydl:
-                try:
-                    await get_running_loop().run_in_executor(None, partial(ydl.process_info, vid))
-                    vid["filename"] = ydl.prepare_filename(vid)
-                    self.parent.storage["downloaded_songs"][vid["filename"]] = time()
-                    self.parent.storage.save()
-                except YoutubeDLError as e:
-                    await self.text_channel.send(f"**WARNING. An error occurred while downloading video "
-                                                 f"{vid['title']}. It will not be queued.\nError details:** `{e}`")
-                    return
+            return None, None
+        # Skip over videos that are too long
+        if vid.get("duration", 0) > get_guild_config(self.parent, self.gid, "max_video_length"):
+            max_len = pretty_duration(get_guild_config(self.parent, self.gid, "max_video_length"))
+            return None, f"**WARNING: Video {vid['title']} exceeds the maximum video length ({max_len}). It will " \
+                         f"not be added.**"
         vid.setdefault("title", "Unknown")
         vid.setdefault("is_live", False)
         vid.setdefault("duration", 0)
         if vid["duration"] < 0:
             vid["duration"] = 0
-        self.queue.append(vid)
+        return vid, None
+
+    def _cached_video(self, url=None, entry=None):
+        """
+        Looks a video up in the audio and metadata caches, so that it can be queued without asking youtube-dl.
+        :return: The cached video info, or None if it isn't cached.
+        """
+        extractor = self.parent.extractor
+        key = extractor.key_for_entry(entry) if entry is not None else extractor.key_for_url(url)
+        if self.parent.plugin_config["save_audio"]:
+            vid = self.parent.audio_cache.get(key)
+            if vid:
+                return vid
+        return self.parent.metadata_cache.get(key)
+
+    async def _extract_info(self, url):
+        vid = await self.parent.extractor.extract_info(self.gid, url)
+        if vid and vid.get("_type") != "playlist":
+            vid["resolved_at"] = timestamp()
+            self.parent.metadata_cache.add(vid, self.parent.extractor.key_for_url(url))
+        elif vid:
+            for entry in vid["entries"]:
+                if entry and entry.get("_type") not in ("url", "url_transparent"):
+                    entry["resolved_at"] = timestamp()
+        return vid
+
+    async def _refresh_video(self, vid):
+        # Media URLs of videos from the metadata cache may have expired by now
+        if vid.pop("stale_url", False):
+            vid.update(await self._extract_info(vid.get("webpage_url") or vid["url"]))
+
+    def _prepare(self, vid):
+        # Shared between the prefetcher and _play, so that a video is never prepared twice at once
+        task = self._preparing.get(id(vid))
+        if task is None:
+            task = self._preparing[id(vid)] = create_task(self._prepare_video(vid))
+            task.add_done_callback(lambda _: self._preparing.pop(id(vid), None))
+        return task
+
+    async def _prepare_video(self, vid):
+        """
+        Gets a queued video ready to play: downloads its file if audio is saved, or makes sure its stream URL is
+        fresh otherwise.
+        """
+        if vid["is_live"] or not self.parent.plugin_config["save_audio"]:
+            max_age = self.parent.plugin_config.get("stream_url_max_age", 1800)
+            if timestamp() - vid.get("resolved_at", 0) > max_age:
+                vid["stale_url"] = True
+            await self._refresh_video(vid)
+        elif not vid.get("filename") or not Path(vid["filename"]).is_file():
+            await self._refresh_video(vid)
+            vid["filename"] = await self.parent.extractor.download(self.gid, vid)
+            self.parent.audio_cache.add(vid)
+            self.parent.metadata_cache.add(vid)
+            self.parent.storage.save()
+
+    def upcoming(self, count):
+        """
+        :return: Up to count videos expected to play after the current one, as far as the song mode allows telling.
+        """
+        if self.song_mode in (SongMode.NORMAL, SongMode.REPEAT_QUEUE):
+            return self.queue.upcoming(count)
+        elif self.song_mode in (SongMode.SHUFFLE, SongMode.SHUFFLE_REPEAT):
+            return self.queue.upcoming(count, shuffled=True)
+        return []
+
+    def _start_prefetch(self):
+        if self._prefetch_task:
+            self._prefetch_task.cancel()
+        upcoming = self.upcoming(self.parent.plugin_config.get("prefetch_tracks", 2))
+        self._prefetch_task = create_task(self._prefetch(upcoming)) if upcoming else None
+
+    async def _prefetch(self, vids):
+        for vid in vids:
+            try:
+                await shield(self._prepare(vid))
+            except YoutubeDLError as e:
+                # _play gets to try again, and reports the error if it fails too
+                self.logger.info(f"Failed to prefetch {vid['title']}: {e}")
 
     async def _play(self):
+        position = 0
         try:
-            if self.song_mode == SongMode.SHUFFLE_REPEAT:
-                try:
-                    vids = {i for i, _ in enumerate(self.queue)}
-                    eligible_songs = vids - self.already_played
-                    if not eligible_songs:
-                        self.already_played.clear()
-                        eligible_songs = vids
-                    eligible_songs = tuple(eligible_songs)
-                    next_song = eligible_songs[randint(0, len(eligible_songs) - 1)]
-                    self.already_played.add(next_song)
-                    next_song = self.queue[next_song]
-                except ValueError:
-                    next_song = self.queue[0]
+            if self._resume:
+                next_song, position = self._resume
+                self._resume = None
+            elif self.song_mode == SongMode.SHUFFLE_REPEAT:
+                next_song = self.queue.next_shuffled()
             elif self.song_mode == SongMode.SHUFFLE:
-                try:
-                    next_song = self.queue.pop(randint(0, len(self.queue) - 1))
-                except ValueError:
-                    next_song = self.queue.pop()
+                next_song = self.queue.next_shuffled(remove=True)
             elif self.song_mode == SongMode.REPEAT_QUEUE:
                 if self.current_song:
                     self.queue.append(self.current_song)
-                next_song = self.queue.pop(0)
+                next_song = self.queue.popleft()
             elif self.song_mode == SongMode.REPEAT_SONG:
                 if self.current_song:
                     next_song = self.current_song
                 else:
-                    next_song = self.queue.pop(0)
+                    next_song = self.queue.popleft()
             else:
-                next_song = self.queue.pop(0)
+                next_song = self.queue.popleft()
         except IndexError:
             await self.text_channel.send("**ANALYSIS: Queue complete.**")
             self.is_playing = False
             self.current_song = {}
+            self.clear_state()
             self._skip_votes = set()
             self.voice_client.stop()
             try:
@@ -704,9 +852,21 @@ class GuildPlayer:
             except AttributeError:
                 pass
             return
-        before_args = ""
+        try:
+            await shield(self._prepare(next_song))
+        except YoutubeDLError as e:
+            await self.text_channel.send(f"**WARNING. An error occurred while loading video {next_song['title']}. "
+                                         f"It will be skipped.\nError details:** `{e}`")
+            # Otherwise shuffle repeat would keep coming back to it
+            self.queue.discard(next_song)
+            self.current_song = {}
+            await self._play()
+            return
+        before_args = f"-ss {position:.1f}" if position and not next_song["is_live"] else ""
         if self.parent.plugin_config["save_audio"] and not next_song["is_live"]:
             file = next_song["filename"]
+            self.parent.audio_cache.touch(next_song)
+            self.parent.storage.save()
         else:
             file = next_song["url"]
             before_args += " -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 30"
@@ -718,9 +878,11 @@ class GuildPlayer:
         source = PCMVolumeTransformer(FFmpegPCMAudio(file, before_options=before_args, options="-vn"),
                                       volume=self._volume)
         self.voice_client.play(source, after=partial(self._after, loop=get_running_loop()))
-        self._song_start_time = time()
+        self._song_start_time = time() - position
         self.current_song = next_song
         self._skip_votes = set()
+        self._start_prefetch()
+        self.save_state()
         await self.text_channel.send(f"**NOW PLAYING: {next_song['title']}.**")
 
     def toggle_pause(self):
@@ -736,11 +898,76 @@ class GuildPlayer:
     def _after(self, error, loop):
         if error:
             self.logger.error(error)
+        if self.closed:
+            return
         run_coroutine_threadsafe(self._play(), loop)
 
+    def save_state(self):
+        """
+        Snapshots the player to music_players.json, to be resumed by MusicPlayer._restore_players after a restart.
+        The queue is only copied into the snapshot when it changed since the last one.
+        """
+        if self.closed:
+            return
+        self.position_saved_at = time()
+        state = self.parent.player_states.get(self.gid)
+        fields = {
+            "voice_channel": self.voice_client.channel.id,
+            "text_channel": self.text_channel.id,
+            "song_mode": self.song_mode.value,
+            # A temporary volume isn't worth resuming
+            "volume": self.prev_volume or self._volume,
+            "current_song": self._snapshot_video(self.current_song),
+            "position": self.play_time if self.current_song else 0
+        }
+        if state is None or self._saved_queue_version != self.queue.version:
+            fields["queue"] = [self._snapshot_video(vid) for vid in self.queue]
+            self._saved_queue_version = self.queue.version
+        if state is None:
+            self.parent.player_states[self.gid] = fields
+        else:
+            state.update(fields)
+            self.parent.player_states.save(self.gid)
+
+    @staticmethod
+    def _snapshot_video(vid):
+        return {k: vid[k] for k in AudioCache.info_fields + ("filename", "resolved_at", "stale_url") if k in vid}
+
+    def save_position(self):
+        self.position_saved_at = time()
+        try:
+            self.parent.player_states[self.gid]["position"] = self.play_time
+        except KeyError:
+            return
+        self.parent.player_states.save(self.gid)
+
+    def clear_state(self):
+        if not self.closed and self.parent.player_states.pop(self.gid, None) is not None:
+            self.parent.player_states.save(self.gid)
+
+    def restore_state(self, state):
+        """
+        Loads a snapshot made by save_state, and resumes playback from it.
+        :param state: The snapshot, as stored in music_players.json.
+        """
+        self._song_mode = SongMode(state["song_mode"])
+        self._volume = state["volume"]
+        for vid in state["queue"]:
+            self.queue.append(vid)
+        if state["current_song"]:
+            self._resume = (state["current_song"], state["position"])
+        if self._resume or self.queue:
+            self.is_playing = True
+            create_task(self._play())
+        else:
+            self.clear_state()
+
     def stop(self):
         self.is_playing = False
         self._skip_votes = set()
+        if self._prefetch_task:
+            self._prefetch_task.cancel()
+            self._prefetch_task = None
         try:
             self.voice_client.source.cleanup()
         except AttributeError:
@@ -792,13 +1019,20 @@ class GuildPlayer:
             self.voice_client.source.volume = val
         except AttributeError:
             pass
+        self.save_state()
+
+    @property
+    def song_mode(self):
+        return self._song_mode
+
+    @song_mode.setter
+    def song_mode(self, val):
+        self._song_mode = val
+        self.save_state()
 
     @property
     def queue_duration(self):
-        try:
-            return sum(vid["duration"] for vid in self.queue)
-        except TypeError:
-            return 0
+        return self.queue.duration
 
     def print_queue(self):
         str_list = []
@@ -828,10 +1062,418 @@ class GuildPlayer:
         self._alone_time += dt
         if self._alone_time > get_guild_config(self.parent, self.gid, "idle_disconnect_time"):
             self.stop()
+            self.clear_state()
             await self.voice_client.disconnect()
             del self.parent.players[int(self.gid)]
 
 
+class SongQueue:
+    """
+    The queue of a GuildPlayer. Entries get a stable ID when queued, so that removing one never re-indexes the rest.
+    Alongside the queue order, a shuffled permutation of the entry IDs is kept with a cursor into it; the shuffle
+    modes just walk the permutation, and entries removed in the meantime are skipped over lazily.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._order = []
+        self._cursor = 0
+        self.duration = 0
+        # Bumped whenever videos are added or removed, for GuildPlayer.save_state to tell when the queue changed
+        self.version = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def append(self, vid):
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = vid
+        self.duration += vid.get("duration") or 0
+        self.version += 1
+        # Swapped into a random place among the entries not yet played this shuffle round
+        self._order.append(entry_id)
+        swap = randint(self._cursor, len(self._order) - 1)
+        self._order[swap], self._order[-1] = self._order[-1], self._order[swap]
+
+    def clear(self):
+        self._entries.clear()
+        self._order.clear()
+        self._cursor = 0
+        self.duration = 0
+        self.version += 1
+
+    def popleft(self):
+        """
+        :return: The first video in the queue, removed from it.
+        :raises IndexError: If the queue is empty.
+        """
+        try:
+            entry_id = next(iter(self._entries))
+        except StopIteration:
+            raise IndexError("pop from an empty queue") from None
+        return self._remove(entry_id)
+
+    def pop_at(self, index):
+        """
+        :param index: The zero-based position of the video in the queue, as shown by print_queue.
+        :return: The video at that position, removed from the queue.
+        :raises IndexError: If there is no video at that position.
+        """
+        if not 0 <= index < len(self._entries):
+            raise IndexError("queue index out of range")
+        return self._remove(next(islice(self._entries, index, None)))
+
+    def discard(self, vid):
+        for entry_id, entry in self._entries.items():
+            if entry is vid:
+                self._remove(entry_id)
+                return
+
+    def next_shuffled(self, remove=False):
+        """
+        Picks the next video of the current shuffle round, starting a new round once every video has played.
+        :param remove: Whether the video is removed from the queue, or stays to be played again in the next round.
+        :return: The picked video.
+        :raises IndexError: If the queue is empty.
+        """
+        if not self._entries:
+            raise IndexError("pick from an empty queue")
+        while True:
+            if self._cursor >= len(self._order):
+                self.reset_shuffle()
+            entry_id = self._order[self._cursor]
+            self._cursor += 1
+            if entry_id in self._entries:
+                return self._remove(entry_id) if remove else self._entries[entry_id]
+
+    def reset_shuffle(self):
+        """
+        Starts a new shuffle round over every queued video.
+        """
+        self._order = list(self._entries)
+        shuffle(self._order)
+        self._cursor = 0
+
+    def upcoming(self, count, shuffled=False):
+        """
+        :param count: The maximum number of videos to return.
+        :param shuffled: Whether to follow the shuffle order rather than the queue order.
+        :return: The next videos to be picked, without removing them.
+        """
+        if not shuffled:
+            return list(islice(self._entries.values(), count))
+        ids = (entry_id for entry_id in islice(self._order, self._cursor, None) if entry_id in self._entries)
+        return [self._entries[entry_id] for entry_id in islice(ids, count)]
+
+    def _remove(self, entry_id):
+        vid = self._entries.pop(entry_id)
+        self.duration -= vid.get("duration") or 0
+        self.version += 1
+        # Removed IDs are left in the permutation; once they make up most of it, it's compacted
+        if len(self._order) > 2 * len(self._entries) + 16:
+            remaining = [i for i in islice(self._order, self._cursor, None) if i in self._entries]
+            self._order = remaining
+            self._cursor = 0
+        return vid
+
+
+class ExtractorService:
+    """
+    Runs youtube-dl jobs for every guild on a bounded pool of threads, each thread reusing its own YoutubeDL
+    instance. Jobs are queued per guild and handed to the threads round-robin, so a guild queuing a long playlist
+    can't starve the others.
+    """
+
+    def __init__(self, ydl_options, threads=3):
+        self.ydl_options = ydl_options
+        self.threads = max(1, threads)
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="music_extractor")
+        self._local = threading.local()
+        # gid -> deque of (future, job, args) waiting for a thread, in round-robin order
+        self._queues = OrderedDict()
+        self._running = 0
+        self._key_ydl = None
+
+    def extract_info(self, gid, url):
+        """
+        Fetches information about a video or playlist without downloading it.
+        :return: A future resolving to the info dict.
+        """
+        return self._submit(gid, self._extract_info, url)
+
+    def download(self, gid, vid):
+        """
+        Downloads a video whose info was already extracted.
+        :return: A future resolving to the name of the downloaded file.
+        """
+        return self._submit(gid, self._download, vid)
+
+    def key_for_url(self, url):
+        """
+        Works out the cache key of a URL without any network access: "%(id)s-%(extractor)s" when a specific
+        extractor handles it, or the normalized URL otherwise.
+        """
+        try:
+            for ie in self.key_ydl._ies:
+                if ie.suitable(url):
+                    if ie.ie_key() != "Generic":
+                        # IE_NAME can be an instance property, so it's read from the instance, as in key_for_entry
+                        ie_name = self.key_ydl.get_info_extractor(ie.ie_key()).IE_NAME
+                        return f"{ie._match_id(url)}-{ie_name}"
+                    break
+        except Exception:  # extractors are third-party code, a failed match just means a cache miss
+            pass
+        return "url:" + normalize_url(url)
+
+    def key_for_entry(self, entry):
+        """
+        Works out the cache key of a flat playlist entry.
+        """
+        if entry.get("id") and entry.get("ie_key"):
+            try:
+                return f"{entry['id']}-{self.key_ydl.get_info_extractor(entry['ie_key']).IE_NAME}"
+            except Exception:
+                pass
+        return self.key_for_url(entry.get("url", ""))
+
+    @property
+    def key_ydl(self):
+        # only used for matching URLs to extractors, on the event loop
+        if self._key_ydl is None:
+            self._key_ydl = YoutubeDL(self.ydl_options)
+        return self._key_ydl
+
+    def close(self):
+        for queue in self._queues.values():
+            for future, _, _ in queue:
+                future.cancel()
+        self._queues.clear()
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, gid, job, *args):
+        future = get_running_loop().create_future()
+        self._queues.setdefault(gid, deque()).append((future, job, args))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        loop = get_running_loop()
+        while self._running < self.threads and self._queues:
+            gid, queue = next(iter(self._queues.items()))
+            future, job, args = queue.popleft()
+            if queue:
+                self._queues.move_to_end(gid)
+            else:
+                del self._queues[gid]
+            if future.cancelled():
+                continue
+            self._running += 1
+            loop.run_in_executor(self._executor, partial(job, *args)).add_done_callback(
+                partial(self._job_done, future))
+
+    def _job_done(self, future, job_future):
+        self._running -= 1
+        if not future.cancelled():
+            if job_future.cancelled():
+                future.cancel()
+            elif job_future.exception() is not None:
+                future.set_exception(job_future.exception())
+            else:
+                future.set_result(job_future.result())
+        self._dispatch()
+
+    def _ydl(self):
+        try:
+            return self._local.ydl
+        except AttributeError:
+            self._local.ydl = YoutubeDL(self.ydl_options)
+            return self._local.ydl
+
+    def _extract_info(self, url):
+        return self._ydl().extract_info(url, download=False)
+
+    def _download(self, vid):
+        ydl = self._ydl()
+        ydl.process_info(vid)
+        return ydl.prepare_filename(vid)
+
+
+class AudioCache:
+    """
+    Index of the downloaded audio files, keyed by "%(id)s-%(extractor)s" and stored in music_player.json.
+    Entries are kept in least recently played order, so eviction only ever has to look at the oldest ones.
+    Each entry keeps the video info needed to queue the file again without asking youtube-dl.
+    """
+    info_fields = ("id", "extractor", "title", "duration", "is_live", "url", "webpage_url", "thumbnail", "uploader",
+                   "description", "tags", "view_count", "like_count", "dislike_count", "average_rating")
+
+    def __init__(self, storage, config):
+        self.storage = storage
+        self.config = config
+        try:
+            index = storage["audio_cache"]
+        except KeyError:
+            index = storage["audio_cache"] = {}
+        # Files downloaded before the index existed are adopted, but have to be extracted again once
+        for filename in storage.pop("downloaded_songs", {}):
+            try:
+                size = Path(filename).stat().st_size
+            except OSError:
+                continue
+            index[Path(filename).stem] = {"filename": filename, "size": size, "last_played": timestamp(),
+                                          "info": None}
+        storage.save()
+        self.entries = OrderedDict(sorted(index.items(), key=lambda entry: entry[1]["last_played"]))
+        self.total_size = sum(entry["size"] for entry in self.entries.values())
+
+    def get(self, key):
+        """
+        :return: A copy of the cached video info with its filename, or None if the video isn't cached.
+        """
+        entry = self.entries.get(key)
+        if not entry or not entry["info"]:
+            return None
+        if not Path(entry["filename"]).is_file():
+            self._remove(key)
+            return None
+        return {**entry["info"], "filename": entry["filename"]}
+
+    def add(self, vid):
+        key = f"{vid['id']}-{vid['extractor']}"
+        try:
+            size = Path(vid["filename"]).stat().st_size
+        except OSError:
+            return
+        if key in self.entries:
+            self._remove(key)
+        entry = {"filename": vid["filename"], "size": size, "last_played": timestamp(),
+                 "info": {field: vid[field] for field in self.info_fields if field in vid}}
+        self.entries[key] = self.storage["audio_cache"][key] = entry
+        self.total_size += size
+
+    def touch(self, vid):
+        key = f"{vid.get('id')}-{vid.get('extractor')}"
+        if key in self.entries:
+            self.entries[key]["last_played"] = timestamp()
+            self.entries.move_to_end(key)
+
+    def evict(self, in_use=()):
+        """
+        Deletes the least recently played files while the cache is over its size or file budget, along with any
+        that weren't played for video_cache_clear_age seconds.
+        :param in_use: Filenames that must not be deleted.
+        :return: The number of deleted files.
+        """
+        max_bytes = self.config.get("audio_cache_max_bytes", 0)
+        max_files = self.config.get("audio_cache_max_files", 0)
+        max_age = self.config.get("video_cache_clear_age", 0)
+        now = timestamp()
+        size, count = self.total_size, len(self.entries)
+        to_evict = []
+        for key, entry in self.entries.items():
+            over_budget = (max_bytes and size > max_bytes) or (max_files and count > max_files)
+            if not over_budget and not (max_age and now - entry["last_played"] > max_age):
+                break
+            if entry["filename"] in in_use:
+                continue
+            to_evict.append(key)
+            size -= entry["size"]
+            count -= 1
+        evicted = 0
+        for key in to_evict:
+            try:
+                remove_file(self.entries[key]["filename"])
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            self._remove(key)
+            evicted += 1
+        return evicted
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_size -= entry["size"]
+        self.storage["audio_cache"].pop(key, None)
+
+
+class MetadataCache:
+    """
+    Persistent cache of extracted video info, shared by every guild, so that replayed videos can be queued without
+    asking youtube-dl. Only the fields the player and the short parts of NowPlaying use are kept, and entries expire
+    metadata_cache_ttl seconds after extraction. Media URLs expire much sooner than that, so hits are marked to be
+    refreshed before they're used.
+    Stored in music_metadata.sqlite, keyed like the cache, so adding or dropping an entry only writes that entry.
+    """
+    info_fields = ("id", "extractor", "title", "duration", "is_live", "url", "webpage_url", "thumbnail", "uploader",
+                   "view_count", "filename")
+
+    def __init__(self, storage, config):
+        self.storage = storage
+        self.config = config
+        self.entries = OrderedDict(sorted(storage.items(), key=lambda entry: entry[1]["cached_at"]))
+
+    def get(self, key):
+        """
+        :return: A copy of the cached video info, or None if the video isn't cached or its entry expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            self._remove(key)
+            return None
+        vid = {**entry["info"], "stale_url": True}
+        if vid.get("filename") and not Path(vid["filename"]).is_file():
+            del vid["filename"]
+        return vid
+
+    def add(self, vid, *aliases):
+        """
+        Caches the info of a video under its "%(id)s-%(extractor)s" key, and any number of alias keys.
+        Live streams aren't cached, as their info doesn't stay valid.
+        """
+        if not vid.get("id") or not vid.get("extractor") or vid.get("is_live"):
+            return
+        entry = {"info": {field: vid[field] for field in self.info_fields if field in vid}, "cached_at": timestamp()}
+        for key in {f"{vid['id']}-{vid['extractor']}", *aliases}:
+            self.entries.pop(key, None)
+            self.entries[key] = self.storage[key] = entry
+        max_entries = self.config.get("metadata_cache_max_entries", 0)
+        while max_entries and len(self.entries) > max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def expire(self):
+        """
+        Drops expired entries, oldest first.
+        :return: The number of dropped entries.
+        """
+        expired = 0
+        while self.entries and self._expired(next(iter(self.entries.values()))):
+            self._remove(next(iter(self.entries)))
+            expired += 1
+        return expired
+
+    def _expired(self, entry):
+        ttl = self.config.get("metadata_cache_ttl", 0)
+        return ttl and timestamp() - entry["cached_at"] > ttl
+
+    def _remove(self, key):
+        del self.entries[key]
+        if key in self.storage:
+            del self.storage[key]
+
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ""))
+
+
 def seconds_to_minutes(secs, hours=False):
     mn, sec = divmod(secs, 60)
     if hours:
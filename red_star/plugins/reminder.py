@@ -7,7 +7,9 @@ import shlex
 import re
 from discord import Message, HTTPException
 from dataclasses import dataclass
-from asyncio import create_task
+from asyncio import create_task, get_running_loop
+from heapq import heapify, heappush, heappop
+from itertools import count
 
 recurDecode = {
     "h": ('hour', 'hours'),
@@ -24,9 +26,9 @@ class ReminderPlugin(BasePlugin):
     description = "A plugin for setting messages that the bot will send you at a configurable time."
     channel_types = {"reminders"}
 
-    run_timer = False
     timer = None
-    reminder_file_path = None
+    # The longest the timer sleeps for at once, so that it can't drift far from the wall clock
+    max_timer_delay = 3600
 
     # Searches for a DD/MM/YYYY@hh:mm:ss pattern.
     # All the options are optional (searching for 0 to 2/4 digits), and are in named groups for ease of use of results.
@@ -96,6 +98,22 @@ class ReminderPlugin(BasePlugin):
             if str(guild.id) not in self.storage:
                 self.storage[str(guild.id)] = []
 
+        # Min-heap of (fire time, sequence number, gid, reminder), with the timer armed for the earliest one.
+        # Deleted reminders are left in the heap and skipped when they come up; self.scheduled holds the live ones.
+        self.sequence = count()
+        self.scheduled = {}
+        self.queue = [(r.time, next(self.sequence), gid, r) for gid, reminders in self.storage.items()
+                      for r in reminders]
+        heapify(self.queue)
+        for _, _, _, reminder in self.queue:
+            self.scheduled[id(reminder)] = reminder
+        self._arm_timer()
+
+    async def deactivate(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
     @Command("Remind",
              syntax="(message) [-d/--delay DD//@HH:MM:SS] [-t/--time DD/MM/YYYY@HH:MM:SS] [-p/--private] ["
                     "-r/--recurring y/m/d###]",
@@ -184,10 +202,12 @@ class ReminderPlugin(BasePlugin):
         if time < utcnow:
             raise CommandSyntaxError("Red Star cannot presently alter the past.")
 
-        self.storage[str(msg.guild.id)].append(self.Reminder(msg.author.id, msg.channel.id, time,
-                                                             ' '.join(args['reminder']),
-                                                             args['private'], _recur))
-        self.storage.save()
+        gid = str(msg.guild.id)
+        reminder = self.Reminder(msg.author.id, msg.channel.id, time, ' '.join(args['reminder']), args['private'],
+                                 _recur)
+        self.storage[gid].append(reminder)
+        self.storage.save(gid)
+        self._schedule(gid, reminder)
 
         await respond(msg, f"**AFFIRMATIVE: reminder set for {time.strftime('%Y-%m-%d @ %H:%M:%S')} UTC.{_recurstr}**")
 
@@ -214,7 +234,9 @@ class ReminderPlugin(BasePlugin):
             except ValueError:
                 raise CommandSyntaxError("Non-integer index provided")
             if 0 <= index < len(reminder_list):
+                self._unschedule(reminder_list[index])
                 self.storage[gid].remove(reminder_list[index])
+                self.storage.save(gid)
                 await respond(msg, "**AFFIRMATIVE. Reminder removed.**")
             else:
                 raise CommandSyntaxError("Index out of range")
@@ -245,35 +267,94 @@ class ReminderPlugin(BasePlugin):
             except ValueError:
                 raise CommandSyntaxError("Non-integer syntax provided")
             if 0 <= index < len(self.storage[gid]):
+                self._unschedule(self.storage[gid][index])
                 del self.storage[gid][index]
+                self.storage.save(gid)
                 await respond(msg, "**AFFIRMATIVE. Reminder removed.**")
             else:
                 raise CommandSyntaxError("Index out of range")
         else:
             raise CommandSyntaxError
 
-    async def on_global_tick(self, now, _):
-        save_flag = False
-        for guild in filter(lambda x: str(x.id) in self.storage, self.client.guilds):
-            gid = str(guild.id)
-            for reminder in filter(lambda x: x.time <= now, self.storage[gid]):
-                save_flag = True
+    # Scheduling
+
+    def _schedule(self, gid, reminder):
+        self.scheduled[id(reminder)] = reminder
+        heappush(self.queue, (reminder.time, next(self.sequence), gid, reminder))
+        if self.queue[0][3] is reminder:
+            self._arm_timer()
+
+    def _unschedule(self, reminder):
+        self.scheduled.pop(id(reminder), None)
+
+    def _arm_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        while self.queue and self.scheduled.get(id(self.queue[0][3])) is not self.queue[0][3]:
+            heappop(self.queue)
+        if not self.queue:
+            return
+        delay = (self.queue[0][0] - datetime.datetime.utcnow()).total_seconds()
+        self.timer = get_running_loop().call_later(min(max(delay, 0), self.max_timer_delay), self._fire_due)
+
+    # noinspection PyBroadException
+    def _fire_due(self):
+        """
+        Sends every reminder that is due, and re-arms the timer for the next one. Recurring reminders are moved to
+        their next occurrence in place, the rest are removed; only the guilds whose reminders changed are saved.
+        """
+        self.timer = None
+        now = datetime.datetime.utcnow()
+        changed = set()
+        try:
+            while self.queue and self.queue[0][0] <= now:
+                time, _, gid, reminder = heappop(self.queue)
+                if self.scheduled.get(id(reminder)) is not reminder or reminder.time != time:
+                    continue
+                guild = self.client.get_guild(int(gid))
+                if not guild:
+                    # Left in storage, to be picked up again if the bot rejoins the guild
+                    del self.scheduled[id(reminder)]
+                    continue
+                changed.add(gid)
                 try:
-                    channel = None if reminder.dm else self.channel_manager.get_channel(guild, "reminders")
-                except ChannelNotFoundError:
-                    channel = guild.get_channel(reminder.cid)
+                    self._send(guild, reminder)
+                    if reminder.recurring:
+                        # Occurrences missed while the bot was down are skipped, not sent all at once
+                        while reminder.time <= now:
+                            reminder.time = reminder.get_recurring()
+                        heappush(self.queue, (reminder.time, next(self.sequence), gid, reminder))
+                    else:
+                        self._remove(gid, reminder)
+                except Exception:
+                    self.logger.exception(f"Failed to fire reminder \"{reminder.text[:50]}\" in guild {gid}, "
+                                          f"dropping it.", exc_info=True)
+                    self._remove(gid, reminder)
+        finally:
+            try:
+                if changed:
+                    self.storage.save(*changed)
+            finally:
+                self._arm_timer()
+
+    def _remove(self, gid, reminder):
+        self.scheduled.pop(id(reminder), None)
+        reminders = self.storage.get(gid, [])
+        for i, r in enumerate(reminders):
+            if r is reminder:
+                del reminders[i]
+                break
+
+    def _send(self, guild, reminder):
+        try:
+            channel = None if reminder.dm else self.channel_manager.get_channel(guild, "reminders")
+        except ChannelNotFoundError:
+            channel = guild.get_channel(reminder.cid)
 
-                if channel:
-                    create_task(channel.send(f"**<@{reminder.uid}>:**\n{reminder.text}"))
-                else:
-                    usr = guild.get_member(reminder.uid)
-                    if usr:
-                        create_task(usr.send(f"**Reminder from {guild}:**\n{reminder.text}"))
-
-                if reminder.recurring:
-                    self.storage[gid].append(self.Reminder(reminder.uid, reminder.cid, reminder.get_recurring(),
-                                                           reminder.text, reminder.dm, reminder.recurring))
-            # it's easier to create a new list where everything fits rather than delete from old
-            self.storage[gid] = [x for x in self.storage[gid] if x.time > now]
-        if save_flag:
-            self.storage.save()
+        if channel:
+            create_task(channel.send(f"**<@{reminder.uid}>:**\n{reminder.text}"))
+        else:
+            usr = guild.get_member(reminder.uid)
+            if usr:
+                create_task(usr.send(f"**Reminder from {guild}:**\n{reminder.text}"))
@@ -1,4 +1,5 @@
-from sys import argv
+from sys import argv, stdin, stdout
+import json
 import math
 import random
 
@@ -78,9 +79,23 @@ def _parse_rpn(args):
     return [*out, *stack]
 
 
+def _serve():
+    # worker mode: one JSON list of arguments per line in, one JSON reply per line out
+    for line in stdin:
+        try:
+            reply = {"result": [str(x) for x in _parse_rpn(json.loads(line))]}
+        except Exception as e:
+            reply = {"error": str(e)}
+        stdout.write(json.dumps(reply) + "\n")
+        stdout.flush()
+
+
 if __name__ == "__main__":
-    try:
-        print(" ".join(str(x) for x in _parse_rpn(argv[1:])))
-    except (ValueError, ZeroDivisionError, SyntaxError) as e:
-        print(e)
-        raise Exception()
+    if argv[1:] == ["--worker"]:
+        _serve()
+    else:
+        try:
+            print(" ".join(str(x) for x in _parse_rpn(argv[1:])))
+        except (ValueError, ZeroDivisionError, SyntaxError) as e:
+            print(e)
+            raise Exception()
@@ -101,31 +101,51 @@ def minify(program: [str, list]):
     return reprint(program if isinstance(program, list) else parse(program))
 
 
+def has_mutable_literals(ast) -> bool:
+    """
+    Checks whether an RSLisp AST contains quoted lists. Those are handed to the program as-is when evaluated, so the
+    program can mutate them, and such an AST mustn't be shared between runs.
+    :param ast:
+    :return:
+    """
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list) and node:
+            if node[0] == _quote and len(node) > 1 and isinstance(node[1], list):
+                return True
+            stack.extend(node)
+    return False
+
+
 def read_from_tokens(tokens):
-    if len(tokens) == 0:
-        raise CustomCommandSyntaxError('unexpected EOF while reading')
-    token = tokens.pop(0)
-
-    if token[0] == token[-1] == '"':
-        return ['quote', l_restore(token[1:-1])]
-
-    elif '(' == token:
-        token_list = []
-        while tokens[0] != ')':
-            t = read_from_tokens(tokens)
-            if not isinstance(t, Empty) and t != '':
-                token_list.append(t)
-        tokens.pop(0)
-        return token_list
-
-    elif token.startswith(';'):
-        return Empty()
-
-    elif ')' == token:
-        raise CustomCommandSyntaxError('unexpected )')
-    else:
-        # regexp strips leading/trailing whitespace
-        return atom(re.sub(r"^\s+|\s+$", "", token))
+    """
+    Reads the first expression out of a list of tokens. Works iteratively with an explicit stack, so nesting depth
+    isn't bounded by the recursion limit and every token is only looked at once.
+    :param tokens: A list of tokens, as produced by tokenize.
+    :return: The expression's AST.
+    """
+    stack = []
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+            continue
+        elif token == ')':
+            if not stack:
+                raise CustomCommandSyntaxError('unexpected )')
+            expr = stack.pop()
+        elif token[0] == token[-1] == '"':
+            expr = ['quote', l_restore(token[1:-1])]
+        elif token.startswith(';'):
+            if stack:
+                continue
+            return Empty()
+        else:
+            expr = atom(token)
+        if not stack:
+            return expr
+        stack[-1].append(expr)
+    raise CustomCommandSyntaxError('unexpected EOF while reading')
 
 
 def atom(token: str):
@@ -149,11 +169,16 @@ def atom(token: str):
 
 # A user-defined Scheme procedure.
 class Procedure(object):
-    def __init__(self, parms, body, env):
+    def __init__(self, parms, body, env, compiled_body=None):
         self.parms, self.body, self.env = parms, body, env
+        self.compiled_body = compiled_body
 
     def __call__(self, *args):
-        return lisp_eval(self.body, Env(self.parms, args, self.env))
+        if self.compiled_body is None:
+            return lisp_eval(self.body, Env(self.parms, args, self.env))
+        env = Env(self.parms, args, self.env)
+        _check_runtime(env)
+        return self.compiled_body(env)
 
 
 class Env(dict):
@@ -161,8 +186,13 @@ class Env(dict):
         super().__init__()
         self.update(zip(parms, args))
         self.outer = outer
-        self.timestamp = time()
-        self.max_runtime = max_runtime
+        if outer is not None and not max_runtime:
+            # procedure environments share the deadline of the environment they were defined in
+            self.timestamp = outer.timestamp
+            self.max_runtime = outer.max_runtime
+        else:
+            self.timestamp = time()
+            self.max_runtime = max_runtime
 
     # Find the innermost Env where var appears.
     def find(self, var):
@@ -510,9 +540,277 @@ def lisp_eval(x, env=None):
             args = [lisp_eval(arg, env) for arg in x[1:]]
             return proc(*args)
     except Exception as e:
-        if len(str(e)) > 1500:
-            e = "..." + re.match(r"(?:.+)(\(.+?\): .+?$)", str(e)).group(1)
+        raise _wrap_error(x, e)
+
+
+def _wrap_error(x, e):
+    if len(str(e)) > 1500:
+        e = "..." + re.match(r"(?:.+)(\(.+?\): .+?$)", str(e)).group(1)
+    try:
+        return CustomCommandSyntaxError(f"({x[0]}): {e}")
+    except IndexError:
+        return CustomCommandSyntaxError(e)
+
+
+# Compile an expression into a Python closure taking an environment.
+# The closures follow lisp_eval's semantics (including the error messages), but special forms and symbol accessors
+# are resolved once, and the runtime limit is only checked on loop iterations and procedure calls.
+def lisp_compile(x):
+    if isinstance(x, Empty):
+        return _compile_const(None)
+    elif isinstance(x, Symbol):
+        compiler = _compile_symbol
+    elif not isinstance(x, list):
+        return _compile_const(x)
+    elif not x:
+        compiler = _compile_call  # fails the same way lisp_eval does, on the x[0] lookup
+    else:
+        compiler = _compilers.get(x[0], _compile_call) if isinstance(x[0], str) else _compile_call
+    try:
+        return compiler(x)
+    except Exception as e:
+        # malformed forms only fail once they are reached, like they would in lisp_eval
+        return _compile_raise(x, e)
+
+
+def _check_runtime(env):
+    if env.max_runtime != 0 and time() - env.timestamp > env.max_runtime:
+        raise CustomCommandSyntaxError("The command ran too long.")
+
+
+def _compile_const(value):
+    return lambda env: value
+
+
+def _compile_raise(x, e):
+    def run(env):
+        raise _wrap_error(x, e)
+    return run
+
+
+def _compile_symbol(x):
+    l, *ind = x.split(':')
+    if not ind:
+        def run(env):
+            try:
+                return env.find(l)[l]
+            except Exception as e:
+                raise _wrap_error(x, e)
+        return run
+    ind = [(True, int(i)) if isnum(i) else (False, lisp_compile(i)) for i in ind]
+
+    def run(env):
+        try:
+            indexes = [i if const else i(env) for const, i in ind]
+            return _lget(env.find(l)[l], *indexes)
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_args(x):
+    def run(env):
+        try:
+            argstring = env.find('argstring')['argstring']
+            arglist = env.find('args')['args']
+            if len(x) == 1:
+                return argstring
+            if len(x) == 2:
+                if x[1] == '*':
+                    return arglist
+                else:
+                    try:
+                        return arglist[x[1]]
+                    except IndexError:
+                        return None
+            else:
+                try:
+                    if x[1] == '*':
+                        return arglist[:x[2]]
+                    elif x[2] == '*':
+                        return arglist[x[1]:]
+                    else:
+                        return arglist[x[1]:x[2]]
+                except IndexError:
+                    return []
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_quote(x):
+    (_, exp) = x
+    return _compile_const(exp)
+
+
+def _compile_access(x):
+    items = [lisp_compile(i) for i in x[1:]]
+
+    def run(env):
+        try:
+            a = [i(env) for i in items]
+            try:
+                ar, kw = get_args(a[2:])
+                return getattr(a[1], a[0])(*ar, **kw)
+            except AttributeError:
+                raise CustomCommandSyntaxError(f'{type(a[1])} has no method {a[0]}')
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_if(x):
+    (_, test, conseq, alt) = x
+    test, conseq, alt = lisp_compile(test), lisp_compile(conseq), lisp_compile(alt)
+
+    def run(env):
+        try:
+            return (conseq if test(env) else alt)(env)
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_define(x):
+    (_, var, exp) = x
+    exp = lisp_compile(exp)
+
+    def run(env):
+        try:
+            env[var] = exp(env)
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_set(x):
+    (_, var, exp) = x
+    exp = lisp_compile(exp)
+    if ':' in var:
+        l, *ind = var.split(':')
+        ind = [(True, int(i)) if isnum(i) else (False, lisp_compile(i)) for i in ind]
+
+        def run(env):
+            try:
+                indexes = [i if const else i(env) for const, i in ind]
+                _lset(env.find(l)[l], exp(env), *indexes)
+            except Exception as e:
+                raise _wrap_error(x, e)
+    else:
+        def run(env):
+            try:
+                env.find(var)[var] = exp(env)
+            except Exception as e:
+                raise _wrap_error(x, e)
+    return run
+
+
+def _compile_lambda(x):
+    (_, parms, body) = x
+    compiled_body = lisp_compile(body)
+
+    def run(env):
+        return Procedure(parms, body, env, compiled_body)
+    return run
+
+
+def _compile_while(x):
+    test = lisp_compile(x[1])
+    if len(x) > 2:
+        body = lisp_compile(x[2])
+    else:
+        def body(_):
+            raise IndexError("list index out of range")
+
+    def run(env):
+        try:
+            while test(env):
+                body(env)
+                _check_runtime(env)
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_print(x):
+    items = [lisp_compile(i) for i in x[1:]]
+
+    def run(env):
+        try:
+            try:
+                env.find('_rsoutput')['_rsoutput'] += f'{" ".join(map(lambda y: str(y(env)), items))}\n'
+            except IndexError:
+                env.find('_rsoutput')['_rsoutput'] += '\n'
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_try(x):
+    expr, *args = x[1:]
+    expr = lisp_compile(expr)
+    handler = lisp_compile(args[0]) if args else None
+
+    def run(env):
+        try:
+            try:
+                return expr(env)
+            except Exception as e:
+                if handler is not None:
+                    return handler(env)
+                else:
+                    return e
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_unquote(x):
+    exp = lisp_compile(x[1])
+
+    def run(env):
+        try:
+            return lisp_compile(exp(env))(env)
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_raise_form(x):
+    exp = lisp_compile(x[1])
+
+    def run(env):
+        try:
+            raise CustomCommandSyntaxError(exp(env))
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+def _compile_call(x):
+    proc = lisp_compile(x[0])
+    args = [lisp_compile(arg) for arg in x[1:]]
+
+    def run(env):
         try:
-            raise CustomCommandSyntaxError(f"({x[0]}): {e}")
-        except IndexError:
-            raise CustomCommandSyntaxError(e)
+            return proc(env)(*[arg(env) for arg in args])
+        except Exception as e:
+            raise _wrap_error(x, e)
+    return run
+
+
+_compilers = {
+    _args: _compile_args,
+    _quote: _compile_quote,
+    _access: _compile_access,
+    _if: _compile_if,
+    _define: _compile_define,
+    _def: _compile_define,
+    _set: _compile_set,
+    _lambda: _compile_lambda,
+    _while: _compile_while,
+    _print: _compile_print,
+    _try: _compile_try,
+    _unquote: _compile_unquote,
+    _raise: _compile_raise_form
+}
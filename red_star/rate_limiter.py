@@ -0,0 +1,75 @@
+from collections import Counter
+from time import monotonic
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter. Each key gets a bucket holding up to `uses` tokens that refills at `uses` tokens per
+    `seconds`; every call spends a token. A bucket costs a small fixed amount of memory, and buckets left idle long
+    enough to have refilled are dropped.
+    """
+
+    def __init__(self, idle_expiry=600, max_limited_names=100):
+        """
+        :param idle_expiry: Seconds a bucket has to be left alone before it may be dropped. Buckets are never dropped
+        before they've had time to refill.
+        :param max_limited_names: How many of the most refused names to keep counting refusals for.
+        """
+        self.idle_expiry = idle_expiry
+        self.max_limited_names = max_limited_names
+        # key -> [tokens left, time of last update, whether the cooldown was announced, refill period]
+        self.buckets = {}
+        self.counters = Counter()
+        # name -> times it was refused, trimmed down to the most refused names once it holds twice as many as kept
+        self.limited = Counter()
+        self._last_sweep = monotonic()
+
+    def acquire(self, limits, name=None):
+        """
+        Spends a token from each of several buckets, or from none of them if any is empty.
+        :param limits: An iterable of (key, (uses, seconds)) pairs.
+        :param name: What is being limited, such as a command name, to count refusals under.
+        :return: A tuple of the seconds until every bucket has a token again (0 if the tokens were spent), and
+        whether this is the first refusal since the last success, so the caller knows when to announce the cooldown.
+        """
+        now = monotonic()
+        if now - self._last_sweep > self.idle_expiry:
+            self.sweep(now)
+        buckets = []
+        retry_after = 0
+        for key, (uses, seconds) in limits:
+            try:
+                bucket = self.buckets[key]
+                bucket[0] = min(uses, bucket[0] + (now - bucket[1]) * uses / seconds)
+                bucket[1] = now
+            except KeyError:
+                bucket = self.buckets[key] = [uses, now, False, seconds]
+            bucket[3] = seconds
+            if bucket[0] < 1:
+                retry_after = max(retry_after, (1 - bucket[0]) * seconds / uses)
+            buckets.append(bucket)
+        if retry_after:
+            empty = [bucket for bucket in buckets if bucket[0] < 1]
+            first_refusal = not any(bucket[2] for bucket in empty)
+            for bucket in empty:
+                bucket[2] = True
+            self.counters["limited"] += 1
+            if name is not None:
+                self.limited[name] += 1
+                if len(self.limited) > 2 * self.max_limited_names:
+                    self.limited = Counter(dict(self.limited.most_common(self.max_limited_names)))
+            return retry_after, first_refusal
+        for bucket in buckets:
+            bucket[0] -= 1
+            bucket[2] = False
+        self.counters["allowed"] += 1
+        return 0, False
+
+    def sweep(self, now=None):
+        """
+        Drops the buckets that have been idle long enough to have refilled.
+        """
+        if now is None:
+            now = monotonic()
+        self.buckets = {k: b for k, b in self.buckets.items() if now - b[1] < max(self.idle_expiry, b[3])}
+        self._last_sweep = now
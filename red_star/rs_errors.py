@@ -27,6 +27,16 @@ class ConsoleCommandSyntaxError(CommandSyntaxError):
     pass
 
 
+class WorkerError(Exception):
+    # For when a worker process dies or replies with garbage
+    pass
+
+
+class WorkerTimeoutError(WorkerError):
+    # For when a worker process fails to reply in time and gets killed
+    pass
+
+
 class DataCarrier(Exception):
     # This is intended to carry a message up out of a stack, not to signal any actual error.
     def __init__(self, data):
@@ -1,5 +1,7 @@
 # Miscellaneous utility functions and classes found here.
 import argparse
+import asyncio
+import logging
 import re
 import json
 from red_star.rs_errors import CommandSyntaxError
@@ -11,14 +13,22 @@ class JsonFileDict(dict):
     Dictionary subclass that handles saving the file on edits automatically.
     Try not to instantiate this class directly; instead, use the config_manager's factory method,
     ConfigManager.get_plugin_config_file.
+    If write_delay is above zero, saves are write-behind: the file is only marked dirty, and all saves within
+    the delay window are coalesced into one write. The data is serialized on the event loop, so that it can't change
+    halfway through, and written to disk off it. A failed write is retried after another delay.
     :param pathlib.Path path: The path that should be saved to.
+    :param float write_delay: The number of seconds to coalesce saves for. 0 saves immediately.
     """
 
-    def __init__(self, path, json_save_args=None, json_load_args=None, **kwargs):
+    def __init__(self, path, json_save_args=None, json_load_args=None, write_delay=0, **kwargs):
         super().__init__(**kwargs)
         self.path = path
         self.json_save_args = {} if json_save_args is None else json_save_args
         self.json_load_args = {} if json_load_args is None else json_load_args
+        self.write_delay = write_delay
+        self._dirty = False
+        self._flush_handle = None
+        self._write_lock = None
         self.reload()
 
     def __setitem__(self, key, value):
@@ -29,11 +39,76 @@ class JsonFileDict(dict):
         super().__delitem__(key)
         self.save()
 
-    def save(self):
-        with self.path.open("w", encoding="utf-8") as fd:
-            json.dump(self, fd, **self.json_save_args)
+    def save(self, *keys):
+        """
+        Saves the file.
+        :param keys: The top-level keys that changed. The whole file is written regardless; they're accepted so that
+        callers can give them to any storage backend.
+        """
+        if self.write_delay <= 0:
+            self.flush()
+            return
+        self._dirty = True
+        if self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:  # No loop to defer to, so just write it now.
+                self.flush()
+                return
+            self._flush_handle = loop.call_later(self.write_delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        asyncio.create_task(self.flush_async())
+
+    # noinspection PyBroadException
+    async def flush_async(self):
+        """
+        Writes the file if it has unsaved changes, writing in an executor thread.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            # Anything changed while we're writing will mark us dirty again and schedule another write.
+            self._dirty = False
+            try:
+                data = json.dumps(self, **self.json_save_args)
+                await asyncio.get_running_loop().run_in_executor(None, self._write_data, data)
+            except Exception:
+                logging.getLogger("red_star.rs_utils").exception(f"Failed to save {self.path}, retrying later.",
+                                                                 exc_info=True)
+                self._dirty = True
+                self.save()
+
+    def flush(self):
+        """
+        Writes the file immediately, cancelling any pending write-behind save.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._dirty = False
+        self._write()
+
+    def _write(self):
+        self._write_data(json.dumps(self, **self.json_save_args))
+
+    def _write_data(self, data):
+        temp_path = self.path.with_name(self.path.name + "_bak")
+        with temp_path.open("w", encoding="utf-8") as fd:
+            fd.write(data)
+        temp_path.replace(self.path)
 
     def reload(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._dirty = False
         with self.path.open(encoding="utf-8") as fd:
             self.update(json.load(fd, **self.json_load_args))
 
@@ -187,39 +262,78 @@ def split_message(input_string: str, max_len: int = 2000, splitter: str = "\n"):
     :param splitter: The token upon which the function should try to split the string
     :return: A list of strings with closed markdown, each within `max_len` length
     """
-    final_strings = []
-    open_markdown = ""
+    return list(iter_split_message(input_string, max_len, splitter))
+
+
+def iter_split_message(input_string: str, max_len: int = 2000, splitter: str = "\n"):
+    """
+    Generator version of split_message, yielding the chunks as they're cut. Works on offsets into the input string,
+    so only the chunks themselves are ever copied.
+    :param input_string: The input string to be split into chunks
+    :param max_len: The maximum length of a given chunk
+    :param splitter: The token upon which the function should try to split the string
+    :return: An iterator of strings with closed markdown, each within `max_len` length
+    """
     if len(input_string) <= max_len:
-        return [input_string]
-    while True:
-        snippet = input_string[:max_len - len(open_markdown)]
+        yield input_string
+        return
+    open_markdown = ""
+    start = 0
+    total_len = len(input_string)
+    while start < total_len:
+        end = min(start + max_len - len(open_markdown), total_len)
+        # The rest of the string is sent whole if it fits, rather than having its last line split off
+        if end == total_len:
+            snippet_marked_down, extra_md = close_markdown(open_markdown + input_string[start:])
+            if len(snippet_marked_down) <= max_len:
+                yield snippet_marked_down
+                return
         while True:
             # Find the nearest splitter character to the maximum length
-            snippet = snippet.rsplit(splitter, 1)[0] or snippet
-            cut_length = len(snippet)
-            snippet_marked_down = open_markdown + snippet
+            split_pos = input_string.rfind(splitter, start, end)
+            if split_pos > start:
+                end = split_pos
+            snippet = input_string[start:end]
             # Close the markdown
-            snippet_marked_down, extra_md = close_markdown(snippet_marked_down)
-            # If, with markdown closed, it fits, continue. Otherwise, run the loop again.
+            snippet_marked_down, extra_md = close_markdown(open_markdown + snippet)
+            # If, with markdown closed, it fits, continue. Otherwise, try again with less of the string.
             if len(snippet_marked_down) <= max_len:
                 open_markdown = extra_md
                 break
-            elif len(snippet.strip().rsplit(splitter, 1)) <= 1:
-                snippet = snippet[:max_len - len(snippet_marked_down)]
-        final_strings.append(snippet_marked_down)
-        input_string = input_string[cut_length:]  # Cut down the input string for the next iteration
-        if not input_string:
-            return final_strings
+            elif end - start <= 1:
+                # Not even a single character fits next to the reopened markdown, so start over without it
+                if not open_markdown:
+                    break
+                open_markdown = ""
+                end = min(start + max_len, total_len)
+            elif splitter not in snippet.strip():
+                end = max(end - (len(snippet_marked_down) - max_len), start + 1)
+        yield snippet_marked_down
+        start = end
+
+
+_code_block_regex = re.compile(r"```\w+\n")
+_markdown_regex = re.compile(r"(\*\*|\*|~~|__|\|\||```|`)")
 
 
 def close_markdown(input_string):
-    code_block_matches = re.findall(r"```\w+\n", input_string)
-    in2 = re.sub(r"```\w+\n", "```", input_string)
-    md_matches = re.findall(r"(\*\*|\*|~~|__|\|\||```|`)", in2)
-    unclosed_matches = "".join({s for s in md_matches if md_matches.count(s) % 2 != 0})
+    """
+    Closes any markdown left open in a string.
+    :param input_string: The string to close markdown in.
+    :return: A tuple of the string with its markdown closed, and the markdown needed to reopen it in a following
+    string. Markers are closed innermost first; a code block is reopened with the language of the string's first
+    code block.
+    """
+    code_block = _code_block_regex.search(input_string)
+    # marker -> position of its last occurrence, for the markers that occur an odd number of times
+    unclosed = {}
+    for match in _markdown_regex.finditer(_code_block_regex.sub("```", input_string)):
+        if unclosed.pop(match.group(), None) is None:
+            unclosed[match.group()] = match.start()
+    unclosed_matches = "".join(sorted(unclosed, key=unclosed.get, reverse=True))
     output = input_string + unclosed_matches
-    if code_block_matches:
-        unclosed_matches = unclosed_matches.replace("```", code_block_matches[0], 1)
+    if code_block:
+        unclosed_matches = unclosed_matches.replace("```", code_block.group(), 1)
     return output, unclosed_matches
 
 
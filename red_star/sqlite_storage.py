@@ -0,0 +1,279 @@
+"""
+SQLite storage backend for plugin config files. A file using it keeps each top-level key of the dictionary as its own
+row, so saving writes only the keys that changed instead of the whole document.
+
+Plugins opt in per file, either by passing backend="sqlite" to ConfigManager.get_plugin_config_file, or through the
+"storage_backends" section of config.json, which maps file names (or fnmatch patterns) to backends.
+
+Run as a script to convert between the two formats:
+    python -m red_star.sqlite_storage import config/music_player.json
+    python -m red_star.sqlite_storage export config/music_player.sqlite
+"""
+import asyncio
+import json
+import re
+import sqlite3
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+
+# Only plain object/array paths may end up in index definitions, which can't take SQL parameters
+_json_path_regex = re.compile(r"^\$(\.[A-Za-z_][A-Za-z0-9_]*|\[\d+\])*$")
+# Upserts only exist since SQLite 3.24; older versions replace the row, which is the same for a two-column table
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    _upsert_query = "INSERT INTO records (key, value) VALUES (?, ?) " \
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+else:
+    _upsert_query = "INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)"
+
+
+class SqliteFileDict(dict):
+    """
+    Dictionary subclass backed by an SQLite database in WAL mode, with one row per top-level key, stored as JSON.
+    Behaves like JsonFileDict: the whole dictionary is kept in memory, setting or deleting a top-level key saves it,
+    and changes made deeper in the structure are saved by calling save(). save() can be told which keys changed;
+    otherwise the changed keys are found by comparing them with what was last written. The JSON load arguments are
+    applied to the rows put back together into one object, so hooks expecting the file's top-level object still work.
+    Records can be indexed by values inside them, and looked up by those with find and find_range.
+    Try not to instantiate this class directly; instead, use the config_manager's factory method,
+    ConfigManager.get_plugin_config_file.
+    :param pathlib.Path path: The path of the database file.
+    :param float write_delay: The number of seconds to coalesce saves for. 0 saves immediately.
+    """
+
+    def __init__(self, path, json_save_args=None, json_load_args=None, write_delay=0, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.json_save_args = {} if json_save_args is None else json_save_args
+        self.json_load_args = {} if json_load_args is None else json_load_args
+        self.write_delay = write_delay
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # key -> the JSON last written for it, to tell which keys changed
+        self._written = {}
+        self._dirty = set()
+        self._dirty_all = False
+        self._transaction_depth = 0
+        self._flush_handle = None
+        self.reload()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.save(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.save(key)
+
+    def save(self, *keys):
+        """
+        Saves changes to the database.
+        :param keys: The top-level keys that changed. If none are given, every key is checked for changes.
+        """
+        if keys:
+            self._dirty.update(keys)
+        else:
+            self._dirty_all = True
+        if self._transaction_depth:
+            return
+        if self.write_delay <= 0:
+            self.flush()
+            return
+        if self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:  # No loop to defer to, so just write it now.
+                self.flush()
+                return
+            self._flush_handle = loop.call_later(self.write_delay, self.flush)
+
+    async def flush_async(self):
+        """
+        Writes pending changes. Only changed rows are written, which is cheap enough to do on the event loop.
+        """
+        self.flush()
+
+    def flush(self):
+        """
+        Writes pending changes immediately, in a single transaction, cancelling any pending write-behind save.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        keys = set(self) | set(self._written) if self._dirty_all else self._dirty
+        self._dirty = set()
+        self._dirty_all = False
+        upserts = []
+        deletes = []
+        for key in keys:
+            if key in self:
+                value = json.dumps(self[key], **self.json_save_args)
+                if self._written.get(key) != value:
+                    upserts.append((key, value))
+            elif key in self._written:
+                deletes.append((key,))
+        if not upserts and not deletes:
+            return
+        with self.connection:
+            self.connection.executemany(_upsert_query, upserts)
+            self.connection.executemany("DELETE FROM records WHERE key = ?", deletes)
+        self._written.update(upserts)
+        for key, in deletes:
+            del self._written[key]
+
+    def reload(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._dirty = set()
+        self._dirty_all = False
+        super().clear()
+        self._written = dict(self.connection.execute("SELECT key, value FROM records"))
+        super().update(self._decode(self._written.items()))
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups changes so that they are written together, or not at all. Inside the block, saves are only recorded,
+        and everything is written in one database transaction when the block exits. If the block raises, the keys
+        it saved are restored to their last written state instead.
+        Changes made deeper than the top level must still be announced with save() to be part of the transaction.
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self._rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.flush()
+
+    def _rollback(self):
+        if self._dirty_all:
+            self.reload()
+            return
+        for key in self._dirty - self._written.keys():
+            super().pop(key, None)
+        super().update(self._decode((key, self._written[key]) for key in self._dirty & self._written.keys()))
+        self._dirty = set()
+
+    def _decode(self, rows):
+        """
+        Decodes rows as a single JSON object, the way they'd be laid out in a JSON file, so that load hooks see the
+        same structure they would with JsonFileDict.
+        :param rows: An iterable of (key, JSON value) tuples.
+        :return: The decoded mapping of key -> value.
+        """
+        return json.loads("{" + ",".join(f"{json.dumps(key)}:{value}" for key, value in rows) + "}",
+                          **self.json_load_args)
+
+    def create_index(self, path):
+        """
+        Indexes the records by a value inside them, to be looked up with find and find_range.
+        :param path: An SQLite JSON path into each record, such as "$.author".
+        """
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS \"{self._index_name(path)}\" "
+                                f"ON records ({self._json_extract(path)})")
+
+    def find(self, path, value):
+        """
+        :param path: An SQLite JSON path into each record, such as "$.author".
+        :param value: The value to look for.
+        :return: The keys of the records holding that value at that path.
+        """
+        self.flush()
+        query = f"SELECT key FROM records WHERE {self._json_extract(path)} = ?"
+        return [key for key, in self.connection.execute(query, (value,))]
+
+    def find_range(self, path, start=None, end=None, limit=None):
+        """
+        :param path: An SQLite JSON path into each record, such as "$.due".
+        :param start: The lowest value to include, or None for no lower bound.
+        :param end: The value to stop before, or None for no upper bound.
+        :param limit: The maximum number of keys to return, or None for all of them.
+        :return: The keys of the records whose value at that path is in the range, sorted by that value.
+        """
+        self.flush()
+        extract = self._json_extract(path)
+        conditions = [f"{extract} IS NOT NULL"]
+        params = []
+        if start is not None:
+            conditions.append(f"{extract} >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append(f"{extract} < ?")
+            params.append(end)
+        query = f"SELECT key FROM records WHERE {' AND '.join(conditions)} ORDER BY {extract}"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [key for key, in self.connection.execute(query, params)]
+
+    def import_json(self, path):
+        """
+        Replaces the contents of the dictionary with those of a JSON file, and saves them.
+        :param pathlib.Path path: The JSON file to read.
+        """
+        with path.open(encoding="utf-8") as fd:
+            data = json.load(fd, **self.json_load_args)
+        with self.transaction():
+            super().clear()
+            super().update(data)
+            self.save()
+
+    def export_json(self, path):
+        """
+        Writes the contents of the dictionary to a JSON file, as JsonFileDict would.
+        :param pathlib.Path path: The JSON file to write.
+        """
+        data = json.dumps(self, **self.json_save_args)
+        temp_path = path.with_name(path.name + "_bak")
+        with temp_path.open("w", encoding="utf-8") as fd:
+            fd.write(data)
+        temp_path.replace(path)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    @staticmethod
+    def _json_extract(path):
+        if not _json_path_regex.match(path):
+            raise ValueError(f"Invalid JSON path {path}.")
+        return f"json_extract(value, '{path}')"
+
+    @staticmethod
+    def _index_name(path):
+        return "index" + re.sub(r"\W", "_", path[1:])
+
+
+def main():
+    parser = ArgumentParser(description="Converts Red Star config files between JSON and SQLite storage.")
+    parser.add_argument("action", choices=("import", "export"),
+                        help="import converts a JSON file to SQLite, export converts an SQLite file to JSON.")
+    parser.add_argument("source", type=Path, help="The file to convert.")
+    parser.add_argument("destination", type=Path, nargs="?",
+                        help="The file to write. Defaults to the source with the extension swapped.")
+    args = parser.parse_args()
+
+    if args.action == "import":
+        destination = args.destination or args.source.with_suffix(".sqlite")
+        storage = SqliteFileDict(destination, json_save_args={'ensure_ascii': False})
+        storage.import_json(args.source)
+    else:
+        destination = args.destination or args.source.with_suffix(".json")
+        storage = SqliteFileDict(args.source, json_save_args={'ensure_ascii': False})
+        storage.export_json(destination)
+    storage.close()
+    print(f"Converted {args.source} to {destination}, {len(storage)} records.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import logging
+import os
+from asyncio.subprocess import PIPE
+from pathlib import Path
+from red_star.rs_errors import WorkerError, WorkerTimeoutError
+
+
+class WorkerPool:
+    """
+    A pool of long-lived worker processes that talk JSON over their stdin/stdout, one message per line.
+    Workers are spawned on demand, up to the size of the pool. A worker that fails to reply in time, dies or replies
+    with garbage is killed, and a fresh one is spawned in its place by the next request.
+    """
+
+    def __init__(self, args, size=1, env=None, line_limit=2 ** 24):
+        """
+        :param args: The command line used to start a worker.
+        :param size: The maximum number of workers running at once.
+        :param env: The environment variables for the workers, or None to inherit the bot's.
+        :param line_limit: The maximum length of a reply, in bytes.
+        """
+        self.args = args
+        self.size = size
+        self.env = env
+        self.line_limit = line_limit
+        self.logger = logging.getLogger("red_star.worker_pool")
+        self._available = asyncio.Semaphore(size)
+        self._idle = []
+        self._workers = set()
+
+    async def request(self, payload, timeout=None):
+        """
+        Sends a payload to an idle worker and waits for its reply.
+        :param payload: A JSON-serializable request.
+        :param timeout: Seconds to wait for the reply before the worker is killed, or None to wait forever.
+        :return: The decoded reply.
+        :raises WorkerTimeoutError: If the worker didn't reply in time.
+        :raises WorkerError: If the worker couldn't be started, died or replied with garbage.
+        """
+        async with self._available:
+            proc = self._idle.pop() if self._idle else await self._spawn()
+            healthy = False
+            try:
+                proc.stdin.write(json.dumps(payload).encode("utf-8") + b"\n")
+                await proc.stdin.drain()
+                line = await asyncio.wait_for(proc.stdout.readline(), timeout)
+                if not line:
+                    raise WorkerError(f"Worker process exited with code {await proc.wait()}.")
+                reply = json.loads(line)
+                healthy = True
+                return reply
+            except asyncio.TimeoutError:
+                raise WorkerTimeoutError(f"Worker process did not reply in {timeout} seconds.") from None
+            except (OSError, ValueError) as e:
+                raise WorkerError(f"Worker process failed: {e}") from e
+            finally:
+                if healthy:
+                    self._idle.append(proc)
+                else:
+                    await self._kill(proc)
+
+    async def close(self):
+        """
+        Kills every worker, idle or busy.
+        """
+        self._idle.clear()
+        for proc in list(self._workers):
+            await self._kill(proc)
+
+    async def _spawn(self):
+        try:
+            proc = await asyncio.create_subprocess_exec(*self.args, stdin=PIPE, stdout=PIPE, env=self.env,
+                                                        limit=self.line_limit)
+        except (OSError, NotImplementedError) as e:
+            raise WorkerError(f"Could not start worker process: {e}") from e
+        self.logger.debug(f"Started worker process {proc.pid}: {' '.join(map(str, self.args))}")
+        self._workers.add(proc)
+        return proc
+
+    async def _kill(self, proc):
+        self._workers.discard(proc)
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        self.logger.debug(f"Stopped worker process {proc.pid}.")
+
+
+def python_worker_env():
+    """
+    Builds the environment for Python worker scripts, with the red_star package importable from them.
+    :return: A copy of the bot's environment variables with PYTHONPATH extended.
+    """
+    env = os.environ.copy()
+    package_root = str(Path(__file__).resolve().parent.parent)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (package_root, env.get("PYTHONPATH"))))
+    return env